@@ -0,0 +1,507 @@
+"""
+Virus Simulation Benchmarks
+------------------------------------------
+DESCRIPTION:
+Times the hot paths of virus_simulation.py: Patient.update,
+TreatedPatient.update, getResistPop, and end-to-end simulationWithoutDrug
+and simulationWithDrug runs with plotting disabled. The suite covers a
+matrix of population sizes (10^2 to 10^6), drug counts, mutation rates and
+engine backends, and reports the rate (steps, calls or trials per second,
+best of several timing windows, with the spread between them), the memory
+allocated per step and the peak RSS of every case. Each case
+runs in fresh interpreters, so the peak RSS belongs to that case alone.
+Run the suite with:
+    python benchmark.py suite [--quick] [--engines object,array]
+        [--output results.json] [--compare baseline.json] [--threshold 0.25]
+Saving the results of one commit with --output and passing that file to
+--compare on another reports every case whose rate dropped by more than
+the threshold, and exits with status 1 if there is any.
+Other benchmarks:
+    python benchmark.py reproduce     raising vs non-raising reproduction
+    python benchmark.py memory        bytes per virus of the object engine
+    python benchmark.py importtime    import-time budget of virus_simulation
+Running the program without arguments runs all of them.
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import virus_simulation as vs
+
+# Worker processes import virus_simulation before stepping a single patient,
+# so its import must stay cheap and must not pull in the plotting stack.
+IMPORT_TIME_BUDGET = 0.5    # seconds
+FORBIDDEN_IMPORTS = ('pylab', 'matplotlib', 'virus_reporting')
+
+# The benchmark matrix
+POPULATION_SIZES = (10**2, 10**3, 10**4, 10**5, 10**6)
+QUICK_POPULATION_SIZES = (10**2, 10**3, 10**4)
+DRUG_COUNTS = (1, 4)
+MUTATION_RATES = (0.005, 0.05)
+BENCHMARK_ENGINES = ('object', 'array', 'count', 'tau')
+# The object engine and the end-to-end runs take minutes above these sizes
+OBJECT_ENGINE_MAX_POP = 10**5
+END_TO_END_MAX_POP = 10**4
+# Each case runs in CASE_RUNS fresh interpreters and is timed in
+# CASE_REPEATS windows in each, and each window keeps measuring until this
+# much time has passed.
+CASE_RUNS = 3
+CASE_REPEATS = 5
+MIN_CASE_TIME = 0.2     # seconds
+# A fixed pure-Python workload timed just before every window. Comparisons
+# use the median of the window rates relative to it, so neither a single
+# slow window nor a machine that is slower as a whole flags a regression.
+CALIBRATION_SIZE = 20000
+
+
+def reproduceRaising(patient, popDensity, activeDrugs=None):
+    """
+    The reproduction pass of update() as it was before tryReproduce()
+    existed: every virus particle that does not reproduce raises a
+    NoChildException, which the loop catches.
+
+    patient: the patient whose viruses reproduce (a Patient or TreatedPatient)
+    popDensity: the population density (a float)
+    activeDrugs: the DRUGS mask of the active drugs for a TreatedPatient (an
+    integer), or None for a Patient
+
+    returns: the list of offspring
+    """
+    children = []
+    for virus in patient.viruses:
+        try:
+            if activeDrugs is None:
+                children.append(virus.reproduce(popDensity, patient.rng))
+            else:
+                children.append(virus.reproduce(popDensity, activeDrugs, patient.rng))
+        except vs.NoChildException:
+            pass
+    return children
+
+
+def reproduceNonRaising(patient, popDensity, activeDrugs=None):
+    """
+    The reproduction pass of update(), using tryReproduce().
+
+    returns: the list of offspring
+    """
+    children = []
+    for virus in patient.viruses:
+        if activeDrugs is None:
+            child = virus.tryReproduce(popDensity, patient.rng)
+        else:
+            child = virus.tryReproduce(popDensity, activeDrugs, patient.rng)
+        if child is not None:
+            children.append(child)
+    return children
+
+
+def timeSteps(step, numSteps):
+    """
+    Calls step() numSteps times.
+
+    returns: the mean time per call in seconds (a float)
+    """
+    start = time.perf_counter()
+    for i in range(numSteps):
+        step()
+    return (time.perf_counter() - start) / numSteps
+
+
+def benchmarkReproduce(maxPop=100000, numSteps=10):
+    """
+    Compares the reproduction pass of update() with and without exceptions
+    on a population at 95% of its carrying capacity, where nearly every
+    virus particle fails to reproduce. The population is left unchanged
+    between steps, so both passes see the same work.
+    """
+    numViruses = maxPop * 95 // 100
+    popDensity = numViruses / maxPop
+    print('Reproduction pass, population', numViruses, 'of maxPop', maxPop)
+    for name in ('Patient', 'TreatedPatient'):
+        rng = vs.SimulationRNG(0)
+        if name == 'Patient':
+            patient = vs.makePatient('object', numViruses, maxPop, 0.1, 0.05, rng)
+            activeDrugs = None
+        else:
+            patient = vs.makeTreatedPatient('object', numViruses, maxPop, 0.1, 0.05,
+                                            {'guttagonol': True}, 0.005, rng)
+            activeDrugs = vs.DRUGS.getMask(['guttagonol'])
+        raising = timeSteps(lambda: reproduceRaising(patient, popDensity, activeDrugs), numSteps)
+        nonRaising = timeSteps(lambda: reproduceNonRaising(patient, popDensity, activeDrugs), numSteps)
+        print('  %-15s raising: %8.2f ms/step   non-raising: %8.2f ms/step   speedup: %.2fx'
+              % (name, raising * 1000, nonRaising * 1000, raising / nonRaising))
+
+
+def benchmarkVirusMemory(numViruses=100000, numSteps=5):
+    """
+    Measures the memory one virus particle of the object engine takes (the
+    instance, and its slot in the patient's list) and the time of an
+    update() step of a patient at half of its carrying capacity.
+    """
+    print('Object engine,', numViruses, 'viruses')
+    for name in ('SimpleVirus', 'ResistantVirus'):
+        tracemalloc.start()
+        if name == 'SimpleVirus':
+            viruses = [vs.SimpleVirus(0.1, 0.05) for i in range(numViruses)]
+        else:
+            viruses = [vs.ResistantVirus(0.1, 0.05, {'guttagonol': True}, 0.005)
+                       for i in range(numViruses)]
+        bytesPerVirus = tracemalloc.get_traced_memory()[0] / numViruses
+        tracemalloc.stop()
+        rng = vs.SimulationRNG(0)
+        if name == 'SimpleVirus':
+            patient = vs.Patient(viruses[:numViruses // 2], numViruses, rng)
+        else:
+            patient = vs.TreatedPatient(viruses[:numViruses // 2], numViruses, rng)
+            patient.addPrescription('guttagonol')
+        stepTime = timeSteps(patient.update, numSteps)
+        print('  %-15s %6.1f bytes/virus   update: %8.2f ms/step'
+              % (name, bytesPerVirus, stepTime * 1000))
+
+
+def makeCases(populationSizes=POPULATION_SIZES, engines=BENCHMARK_ENGINES):
+    """
+    Builds the benchmark matrix.
+
+    returns: a list of cases, each a dictionary with the keys kind (the code
+    path being timed), engine, maxPop, numDrugs and mutProb
+    """
+    cases = []
+    for engine in engines:
+        for maxPop in populationSizes:
+            if engine == 'object' and maxPop > OBJECT_ENGINE_MAX_POP:
+                continue
+            cases.append({'kind': 'Patient.update', 'engine': engine, 'maxPop': maxPop,
+                          'numDrugs': 0, 'mutProb': 0.0})
+            for numDrugs in DRUG_COUNTS:
+                for mutProb in MUTATION_RATES:
+                    cases.append({'kind': 'TreatedPatient.update', 'engine': engine,
+                                  'maxPop': maxPop, 'numDrugs': numDrugs, 'mutProb': mutProb})
+                cases.append({'kind': 'getResistPop', 'engine': engine, 'maxPop': maxPop,
+                              'numDrugs': numDrugs, 'mutProb': MUTATION_RATES[0]})
+            if maxPop <= END_TO_END_MAX_POP:
+                cases.append({'kind': 'simulationWithoutDrug', 'engine': engine,
+                              'maxPop': maxPop, 'numDrugs': 0, 'mutProb': 0.0})
+                cases.append({'kind': 'simulationWithDrug', 'engine': engine, 'maxPop': maxPop,
+                              'numDrugs': 1, 'mutProb': MUTATION_RATES[0]})
+    return cases
+
+
+def caseKey(case):
+    """
+    Returns the tuple that identifies a case across result files.
+    """
+    return (case['kind'], case['engine'], case['maxPop'], case['numDrugs'], case['mutProb'])
+
+
+def _makeCasePatient(case):
+    """
+    Builds the patient for an update or getResistPop case: half of maxPop
+    viruses, close to the equilibrium population, resistant to the first of
+    numDrugs drugs, which is prescribed.
+    """
+    rng = vs.SimulationRNG(0)
+    numViruses = case['maxPop'] // 2
+    if case['kind'] == 'Patient.update':
+        return vs.makePatient(case['engine'], numViruses, case['maxPop'], 0.1, 0.05, rng)
+    resistances = {'drug'+str(i): i == 0 for i in range(case['numDrugs'])}
+    patient = vs.makeTreatedPatient(case['engine'], numViruses, case['maxPop'], 0.1, 0.05,
+                                    resistances, case['mutProb'], rng)
+    patient.addPrescription('drug0')
+    return patient
+
+
+def _measureRate(call):
+    """
+    Calls call() repeatedly for at least MIN_CASE_TIME seconds.
+
+    returns: the number of calls per second (a float)
+    """
+    numCalls = 0
+    start = time.perf_counter()
+    while True:
+        call()
+        numCalls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_CASE_TIME:
+            return numCalls / elapsed
+
+
+def _calibrationCall():
+    """
+    The calibration workload (see CALIBRATION_SIZE).
+    """
+    return sum([i * i for i in range(CALIBRATION_SIZE)])
+
+
+def _measureRates(call, numRepeats=CASE_REPEATS):
+    """
+    Measures the rate of call() in numRepeats separate windows (see
+    _measureRate), each right after a window of the calibration workload.
+
+    returns: a tuple (rates, calibrationRates) of lists with one rate per
+    window (floats)
+    """
+    rates = []
+    calibrationRates = []
+    for repeat in range(numRepeats):
+        calibrationRates.append(_measureRate(_calibrationCall))
+        rates.append(_measureRate(call))
+    return rates, calibrationRates
+
+
+def runCase(case):
+    """
+    Runs one benchmark case in this process.
+
+    returns: a copy of case with the measurements added: rate (update steps,
+    getResistPop calls or end-to-end trials per second, the best of
+    CASE_REPEATS windows), rates (the rate of every window), spread (the
+    relative gap between the best and worst window), relativeRates (the
+    ratio of each window's rate to the calibration rate measured just before
+    it), relativeRate (their median), allocatedBytes (the
+    peak memory allocated by Python during one call) and peakRSS (the peak
+    resident set size of the process, in kilobytes)
+    """
+    if case['kind'] in ('simulationWithoutDrug', 'simulationWithDrug'):
+        numViruses = max(case['maxPop'] // 10, 1)
+        if case['kind'] == 'simulationWithoutDrug':
+            call = lambda: vs.simulationWithoutDrug(numViruses, case['maxPop'], 0.1, 0.05, 1,
+                                                    case['engine'], seed=0, plot=False)
+        else:
+            call = lambda: vs.simulationWithDrug(numViruses, case['maxPop'], 0.1, 0.05,
+                                                 {'guttagonol': False}, case['mutProb'], 1,
+                                                 case['engine'], seed=0, plot=False)
+    else:
+        patient = _makeCasePatient(case)
+        if case['kind'] == 'getResistPop':
+            patient.update()
+            drugs = ['drug'+str(i) for i in range(case['numDrugs'])]
+            call = lambda: patient.getResistPop(drugs)
+        else:
+            call = patient.update
+    call()    # warm up
+    tracemalloc.start()
+    call()
+    allocatedBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = dict(case)
+    rates, calibrationRates = _measureRates(call)
+    result['rate'] = max(rates)
+    result['rates'] = rates
+    result['spread'] = (max(rates) - min(rates)) / max(rates)
+    result['relativeRates'] = [rate / calibrationRate
+                               for rate, calibrationRate in zip(rates, calibrationRates)]
+    result['relativeRate'] = statistics.median(result['relativeRates'])
+    result['allocatedBytes'] = allocatedBytes
+    result['peakRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def _currentCommit():
+    """
+    Returns the abbreviated hash of the checked-out git commit, or None
+    outside a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _runCaseRuns(case, numRuns=CASE_RUNS):
+    """
+    Runs a case in numRuns fresh interpreters and merges their results: the
+    rates of every window, the best of them and their spread, the median
+    relative rate, and the largest allocation and peak RSS.
+
+    returns: the merged result (see runCase)
+    """
+    runs = []
+    for run in range(numRuns):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', json.dumps(case)],
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output))
+    result = runs[0]
+    rates = [rate for run in runs for rate in run['rates']]
+    result['rate'] = max(rates)
+    result['rates'] = rates
+    result['spread'] = (max(rates) - min(rates)) / max(rates)
+    result['relativeRates'] = [rate for run in runs for rate in run['relativeRates']]
+    result['relativeRate'] = statistics.median(result['relativeRates'])
+    result['allocatedBytes'] = max(run['allocatedBytes'] for run in runs)
+    result['peakRSS'] = max(run['peakRSS'] for run in runs)
+    return result
+
+
+def runSuite(cases):
+    """
+    Runs every case in CASE_RUNS fresh interpreters and prints one line per
+    case, with each engine's rate relative to the object engine where both
+    ran.
+
+    returns: the list of results (see runCase and _runCaseRuns)
+    """
+    results = []
+    objectRates = {}
+    print('%-22s %-7s %8s %5s %6s %14s %7s %14s %10s %8s'
+          % ('case', 'engine', 'maxPop', 'drugs', 'mut', 'rate (/s)', 'spread', 'alloc (B)',
+             'RSS (kB)', 'vs obj'))
+    for case in cases:
+        result = _runCaseRuns(case)
+        results.append(result)
+        key = caseKey(result)[:1] + caseKey(result)[2:]
+        if result['engine'] == 'object':
+            objectRates[key] = result['rate']
+        relative = ('%7.1fx' % (result['rate'] / objectRates[key])) if key in objectRates else ''
+        print('%-22s %-7s %8d %5d %6g %14.1f %6.1f%% %14d %10d %8s'
+              % (result['kind'], result['engine'], result['maxPop'], result['numDrugs'],
+                 result['mutProb'], result['rate'], result['spread'] * 100,
+                 result['allocatedBytes'], result['peakRSS'], relative))
+    return results
+
+
+def compareResults(results, baseline, threshold):
+    """
+    Compares the median relative rates (see runCase) of results against a
+    baseline run, so a change in the speed of the machine between the runs
+    cancels out. Baselines saved without relative rates are compared on
+    their best rates.
+
+    results: the results of this run (see runCase)
+    baseline: the results of the baseline run, as saved with --output (a
+    dictionary with 'commit' and 'results' keys)
+    threshold: the allowed relative drop in rate (a float, e.g. 0.25)
+
+    returns: the list of (result, baselineResult) pairs whose rate dropped by
+    more than threshold
+    """
+    baselineResults = {caseKey(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        baselineResult = baselineResults.get(caseKey(result))
+        if baselineResult is None:
+            continue
+        if 'relativeRate' in result and 'relativeRate' in baselineResult:
+            rate, baselineRate = result['relativeRate'], baselineResult['relativeRate']
+        else:
+            rate, baselineRate = result['rate'], baselineResult['rate']
+        if rate < baselineRate * (1 - threshold):
+            regressions.append((result, baselineResult))
+    print('Compared with', baseline.get('commit') or 'baseline', '-',
+          len(regressions), 'regression(s) beyond', str(int(threshold * 100))+'%')
+    for result, baselineResult in regressions:
+        print('  %s %s maxPop=%d drugs=%d mut=%g: %.1f/s -> %.1f/s'
+              % (result['kind'], result['engine'], result['maxPop'], result['numDrugs'],
+                 result['mutProb'], baselineResult['rate'], result['rate']))
+    return regressions
+
+
+def measureImportTime(numRuns=5):
+    """
+    Measures the import time of virus_simulation in fresh interpreters with
+    python -X importtime.
+
+    numRuns: number of fresh interpreters to measure (an integer)
+
+    returns: a tuple (best, forbidden) of the fastest import time in seconds
+    (a float) and the modules in FORBIDDEN_IMPORTS loaded by any of the runs
+    (a sorted list of strings)
+    """
+    best = None
+    forbidden = set()
+    for run in range(numRuns):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import virus_simulation'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stderr
+        modules = {}
+        for line in output.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                selfTime, cumulative, name = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    modules[name.strip()] = int(cumulative) / 1e6
+        forbidden.update(name for name in modules if name.split('.')[0] in FORBIDDEN_IMPORTS)
+        if best is None or modules['virus_simulation'] < best:
+            best = modules['virus_simulation']
+    return best, sorted(forbidden)
+
+
+def checkImportTime(budget=IMPORT_TIME_BUDGET, numRuns=5):
+    """
+    Checks the import time of virus_simulation against budget (see
+    measureImportTime). Fails if the import pulls in any module in
+    FORBIDDEN_IMPORTS.
+
+    budget: the allowed import time in seconds (a float)
+    numRuns: number of fresh interpreters to measure; the fastest run counts
+    (an integer)
+
+    returns: True if the import is within budget and loads no forbidden
+    module, False otherwise
+    """
+    best, forbidden = measureImportTime(numRuns)
+    print('Import time of virus_simulation: %.1f ms (budget %.1f ms)' % (best * 1000, budget * 1000))
+    if forbidden:
+        print('  imports plotting modules:', ', '.join(forbidden))
+    return best <= budget and not forbidden
+
+
+def main(arguments):
+    """
+    Parses the command line (see the module docstring) and runs the
+    requested benchmarks.
+
+    returns: the exit status (an integer)
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks for virus_simulation.py')
+    parser.add_argument('command', nargs='?', default='all',
+                        choices=('all', 'suite', 'reproduce', 'memory', 'importtime', 'case'))
+    parser.add_argument('case', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--quick', action='store_true',
+                        help='only population sizes up to 10^4')
+    parser.add_argument('--engines', default=','.join(BENCHMARK_ENGINES),
+                        help='comma-separated engine backends to run')
+    parser.add_argument('--output', help='save the suite results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results saved in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative drop in rate before failing')
+    options = parser.parse_args(arguments)
+
+    if options.command == 'case':
+        print(json.dumps(runCase(json.loads(options.case))))
+        return 0
+    if options.command == 'importtime':
+        return 0 if checkImportTime() else 1
+    if options.command == 'reproduce':
+        benchmarkReproduce()
+        return 0
+    if options.command == 'memory':
+        benchmarkVirusMemory()
+        return 0
+    if options.command == 'all':
+        checkImportTime()
+        benchmarkReproduce()
+        benchmarkVirusMemory()
+    populationSizes = QUICK_POPULATION_SIZES if options.quick else POPULATION_SIZES
+    results = runSuite(makeCases(populationSizes, options.engines.split(',')))
+    if options.output:
+        with open(options.output, 'w') as outputFile:
+            json.dump({'commit': _currentCommit(), 'results': results}, outputFile, indent=1)
+    if options.compare:
+        with open(options.compare) as baselineFile:
+            if compareResults(results, json.load(baselineFile), options.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
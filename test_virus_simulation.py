@@ -0,0 +1,94 @@
+import math
+
+import numpy as np
+import pytest
+
+import benchmark
+import virus_simulation as vs
+
+
+NUM_VIRUSES = 100000
+
+
+def clearedFraction(patient):
+    """
+    Runs one update of a patient whose viruses never reproduce.
+
+    returns: the fraction of the viruses cleared by the update (a float)
+    """
+    before = patient.getTotalPop()
+    return (before - patient.update()) / before
+
+
+@pytest.mark.parametrize('clearProb', [0.05, 0.5])
+def test_patient_clearance_rate(clearProb):
+    rng = vs.seedTrial(np.random.SeedSequence(7))
+    viruses = [vs.SimpleVirus(0.0, clearProb) for i in range(NUM_VIRUSES)]
+    patient = vs.Patient(viruses, 2 * NUM_VIRUSES, rng)
+    tolerance = 5 * math.sqrt(clearProb * (1 - clearProb) / NUM_VIRUSES)
+    assert abs(clearedFraction(patient) - clearProb) < tolerance
+
+
+@pytest.mark.parametrize('clearProb', [0.05, 0.5])
+def test_treated_patient_clearance_rate(clearProb):
+    rng = vs.seedTrial(np.random.SeedSequence(7))
+    viruses = [vs.ResistantVirus(0.0, clearProb, {'guttagonol': False}, 0.0)
+               for i in range(NUM_VIRUSES)]
+    patient = vs.TreatedPatient(viruses, 2 * NUM_VIRUSES, rng)
+    tolerance = 5 * math.sqrt(clearProb * (1 - clearProb) / NUM_VIRUSES)
+    assert abs(clearedFraction(patient) - clearProb) < tolerance
+    assert patient.getResistPop(['guttagonol']) == 0
+
+
+def test_import_time_budget():
+    # runs python -X importtime -c "import virus_simulation" in fresh
+    # interpreters
+    best, forbidden = benchmark.measureImportTime(numRuns=3)
+    assert forbidden == []
+    assert best <= benchmark.IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize('steadyStateWindow', [None, 40])
+@pytest.mark.parametrize('engine', vs.ENGINES)
+def test_snapshot_resume_is_bit_identical(engine, steadyStateWindow, tmp_path):
+    seed = vs.makeTrialSeeds(11, 1)[0]
+    args = (100, 1000, 0.1, 0.05, {'guttagonol': False}, 0.005, engine, None)
+    expected = vs.runTrialWithDrug(*args, 300, seed=seed,
+                                   steadyStateWindow=steadyStateWindow)
+    checkpointDir = str(tmp_path / 'withDrug')
+    # interrupted after the snapshots at timesteps 60 and 120
+    vs.runTrialWithDrug(*args, 120, seed=seed, checkpointDir=checkpointDir,
+                        checkpointEvery=60, steadyStateWindow=steadyStateWindow)
+    assert vs.loadSnapshot(checkpointDir)[1] == 120
+    resumed = vs.runTrialWithDrug(*args, 300, seed=seed, checkpointDir=checkpointDir,
+                                  checkpointEvery=60, steadyStateWindow=steadyStateWindow)
+    assert resumed == expected
+
+    expected = vs.runTrialWithoutDrug(100, 1000, 0.1, 0.05, engine, seed=seed,
+                                      steadyStateWindow=steadyStateWindow)
+    checkpointDir = str(tmp_path / 'withoutDrug')
+    first = vs.runTrialWithoutDrug(100, 1000, 0.1, 0.05, engine, seed=seed,
+                                   checkpointDir=checkpointDir, checkpointEvery=60,
+                                   steadyStateWindow=steadyStateWindow)
+    # a second run resumes from the last snapshot the first one wrote
+    assert vs.loadSnapshot(checkpointDir)[1] > 0
+    resumed = vs.runTrialWithoutDrug(100, 1000, 0.1, 0.05, engine, seed=seed,
+                                     checkpointDir=checkpointDir, checkpointEvery=60,
+                                     steadyStateWindow=steadyStateWindow)
+    assert first == expected
+    assert resumed == expected
+
+
+def test_profile_counts_stay_consistent():
+    rng = vs.seedTrial(np.random.SeedSequence(5))
+    viruses = [vs.ResistantVirus(0.1, 0.05, {'guttagonol': False, 'grimpex': True}, 0.05)
+               for i in range(100)]
+    patient = vs.TreatedPatient(viruses, 1000, rng)
+    patient.checkCounts = True
+    for timestep in range(300):
+        if timestep == 150:
+            patient.addPrescription('guttagonol')
+        patient.update()
+        # checkCounts makes every getResistPop() call recount the profiles
+        patient.getResistPop(['guttagonol'])
+    assert sum(patient.profileCounts.values()) == patient.getTotalPop()
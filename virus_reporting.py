@@ -0,0 +1,72 @@
+"""
+Virus Simulation Reporting
+------------------------------------------
+DESCRIPTION:
+Plotting and post-processing for the results of virus_simulation.py.
+This module imports pylab, and with it all of matplotlib, so
+virus_simulation.py only imports it when a simulation is asked to plot.
+Simulation runs, sweeps and worker processes never load it.
+"""
+
+import csv
+import pylab
+
+
+def readCSVResults(path):
+    """
+    Reads a file written by CSVSink and averages every series over the
+    trials.
+
+    path: the CSV file (a string)
+
+    returns: a dictionary mapping each series name to its list of
+    per-timestep averages
+    """
+    with open(path, newline='') as resultsFile:
+        reader = csv.reader(resultsFile)
+        seriesNames = next(reader)[2:]
+        sums = {}
+        trials = set()
+        for row in reader:
+            trials.add(row[0])
+            timestep = int(row[1])
+            for name, value in zip(seriesNames, row[2:]):
+                values = sums.setdefault(name, [])
+                if len(values) < timestep:
+                    values.extend([0] * (timestep - len(values)))
+                values[timestep - 1] += int(value)
+    return {name: [total / len(trials) for total in values] for name, values in sums.items()}
+
+
+def plotAverages(series, title, bands=None):
+    """
+    Plots average virus populations against time steps.
+
+    series: a dictionary mapping plot labels to lists of per-timestep
+    averages
+    title: the plot title (a string)
+    bands: a dictionary mapping plot labels to (low, high) tuples of
+    per-timestep lists, drawn as shaded bands around the averages, or None
+    """
+    for label, values in series.items():
+        line, = pylab.plot(values, label = label)
+        if bands is not None and label in bands:
+            low, high = bands[label]
+            pylab.fill_between(range(len(values)), low, high,
+                               color = line.get_color(), alpha = 0.2)
+    pylab.title(title)
+    pylab.xlabel('Time Steps')
+    pylab.ylabel('Average Virus Population')
+    pylab.legend(loc = 'best')
+    pylab.show()
+
+
+def plotResultsFile(path, title):
+    """
+    Plots the averages of a file written by virus_simulation.CSVSink, as a
+    post-processing step after a headless run.
+
+    path: the CSV file (a string)
+    title: the plot title (a string)
+    """
+    plotAverages(readCSVResults(path), title)
@@ -0,0 +1,415 @@
+"""
+Virus Simulation Service
+------------------------------------------
+DESCRIPTION:
+A local asyncio server that runs simulationWithoutDrug and
+simulationWithDrug on request. Requests are queued onto a pool of worker
+processes, identical requests that arrive while one is running share its
+result, and finished results are cached by (simulation, parameters,
+numTrials, seed): the most recently used ones in memory, and all of them
+in an optional directory on disk, so they survive a restart. Requests
+without a seed draw fresh random numbers and are never cached.
+Run the server with:
+    python virus_service.py [--host 127.0.0.1] [--port 8765] [--workers N]
+        [--cache-size 256] [--cache-dir results-cache]
+and request a simulation by POSTing JSON to /simulate, e.g.:
+    curl -d '{"simulation": "withDrug", "numTrials": 100, "seed": 1,
+              "params": {"maxPop": 1000, "engine": "count"}}' \\
+        http://127.0.0.1:8765/simulate
+The response holds the per-timestep mean, variance and quantiles of every
+series (see TrialAggregator.getSummary). GET /stats reports the cache hits,
+misses and deduplicated requests.
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import virus_simulation as vs
+
+# The parameters each simulation accepts, with the values used for the
+# parameters a request leaves out
+SIMULATION_PARAMS = {
+    'withoutDrug': {'numViruses': 100, 'maxPop': 1000, 'maxBirthProb': 0.1,
+                    'clearProb': 0.05, 'engine': 'object', 'steadyStateWindow': None},
+    'withDrug': {'numViruses': 100, 'maxPop': 1000, 'maxBirthProb': 0.1,
+                 'clearProb': 0.05, 'resistances': {'guttagonol': False},
+                 'mutProb': 0.005, 'engine': 'object', 'schedule': None,
+                 'numSteps': 300, 'steadyStateWindow': None},
+}
+# The parameters that must be probabilities
+PROBABILITY_PARAMS = ('maxBirthProb', 'clearProb', 'mutProb')
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def makeRequestParams(simulation, params):
+    """
+    Checks the parameters of a request and fills in the defaults, so that
+    requests that differ only in the parameters they spell out share a
+    cache entry.
+
+    simulation: 'withoutDrug' or 'withDrug' (a string)
+    params: the parameters of the request (a dictionary)
+
+    returns: a dictionary with a value for every parameter of the simulation
+    """
+    if simulation not in SIMULATION_PARAMS:
+        raise ValueError('Unknown simulation: '+str(simulation))
+    defaults = SIMULATION_PARAMS[simulation]
+    for name in params:
+        if name not in defaults:
+            raise ValueError('Unknown parameter of '+simulation+': '+str(name))
+    fullParams = dict(defaults)
+    fullParams.update(params)
+    _checkParams(fullParams)
+    return fullParams
+
+
+def _isInteger(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _checkParams(params):
+    """
+    Checks the types and ranges of request parameters, so that a bad request
+    is rejected before it reaches the process pool.
+
+    Raises a ValueError describing the first bad parameter.
+    """
+    if not _isInteger(params['numViruses']) or params['numViruses'] < 0:
+        raise ValueError('numViruses must be a non-negative integer')
+    if not _isInteger(params['maxPop']) or params['maxPop'] < 1:
+        raise ValueError('maxPop must be a positive integer')
+    for name in PROBABILITY_PARAMS:
+        if name in params and not (_isNumber(params[name]) and 0 <= params[name] <= 1):
+            raise ValueError(name+' must be a number between 0 and 1')
+    engine = params['engine']
+    if not isinstance(engine, str) or engine.partition(':')[0] not in vs.ENGINES:
+        raise ValueError('engine must be one of '+', '.join(vs.ENGINES)+" or 'tau:<tolerance>'")
+    if engine.startswith('tau:'):
+        try:
+            float(engine.partition(':')[2])
+        except ValueError:
+            raise ValueError('The tau tolerance must be a number: '+engine)
+    window = params['steadyStateWindow']
+    if window is not None and (not _isInteger(window) or window < 2):
+        raise ValueError('steadyStateWindow must be null or an integer of at least 2')
+    if 'numSteps' not in params:
+        return
+    if not _isInteger(params['numSteps']) or params['numSteps'] < 1:
+        raise ValueError('numSteps must be a positive integer')
+    resistances = params['resistances']
+    if not isinstance(resistances, dict) or not all(
+            isinstance(drug, str) and isinstance(isResistant, bool)
+            for drug, isResistant in resistances.items()):
+        raise ValueError('resistances must map drug names to true or false')
+    drugs = set(resistances)
+    schedule = params['schedule']
+    if schedule is not None:
+        if not isinstance(schedule, dict):
+            raise ValueError('schedule must be null or an object with events and regimens')
+        events = schedule.get('events', [])
+        regimens = schedule.get('regimens', [])
+        if not (isinstance(events, list) and all(
+                isinstance(event, list) and len(event) == 3 and _isInteger(event[0])
+                and event[0] >= 0 and isinstance(event[1], str) and isinstance(event[2], bool)
+                for event in events)):
+            raise ValueError('schedule events must be [timestep, drug, isActive] lists')
+        if not (isinstance(regimens, list) and all(
+                isinstance(regimen, list) and len(regimen) == 5
+                and isinstance(regimen[0], str)
+                and all(_isInteger(value) and value >= 0 for value in regimen[1:4])
+                and (regimen[4] is None or _isInteger(regimen[4]) and regimen[4] >= 0)
+                and regimen[2] + regimen[3] > 0
+                for regimen in regimens)):
+            raise ValueError('schedule regimens must be '
+                             '[drug, start, onSteps, offSteps, numCycles] lists')
+        positions = schedule.get('regimenPositions', [len(events)] * len(regimens))
+        if not (isinstance(positions, list) and len(positions) == len(regimens)
+                and all(_isInteger(position) and 0 <= position <= len(events)
+                        for position in positions)
+                and positions == sorted(positions)):
+            raise ValueError('schedule regimenPositions must be one non-decreasing '
+                             'event count per regimen')
+        drugs.update(event[1] for event in events)
+        drugs.update(regimen[0] for regimen in regimens)
+    if len(drugs) > vs.DrugRegistry.MAX_DRUGS:
+        raise ValueError('A simulation can use at most '+str(vs.DrugRegistry.MAX_DRUGS)+' drugs')
+
+
+def makeRequestKey(simulation, params, numTrials, seed):
+    """
+    Returns the string that identifies the result of a request (the
+    parameters as returned by makeRequestParams).
+    """
+    return json.dumps([simulation, params, numTrials, seed], sort_keys=True)
+
+
+def runSimulation(simulation, params, numTrials, seed):
+    """
+    Runs a simulation headless in this process. Runs on the workers of the
+    service's process pool.
+
+    returns: the statistics of the trials (see TrialAggregator.getSummary)
+    """
+    # every request starts from an empty drug registry, so the drugs of
+    # earlier requests neither fill the table nor change the result
+    vs.DRUGS.clear()
+    aggregator = vs.TrialAggregator()
+    if simulation == 'withoutDrug':
+        vs.simulationWithoutDrug(params['numViruses'], params['maxPop'],
+                                 params['maxBirthProb'], params['clearProb'], numTrials,
+                                 params['engine'], seed=seed, plot=False,
+                                 aggregator=aggregator,
+                                 steadyStateWindow=params['steadyStateWindow'])
+    else:
+        schedule = params['schedule']
+        if schedule is not None:
+            schedule = vs.DosingSchedule.fromDict(schedule)
+        vs.simulationWithDrug(params['numViruses'], params['maxPop'], params['maxBirthProb'],
+                              params['clearProb'], params['resistances'], params['mutProb'],
+                              numTrials, params['engine'], seed=seed, plot=False,
+                              schedule=schedule, numSteps=params['numSteps'],
+                              aggregator=aggregator,
+                              steadyStateWindow=params['steadyStateWindow'])
+    return aggregator.getSummary()
+
+
+class ResultCache(object):
+    """
+    Finished results by request key: a size-bounded LRU in memory, backed by
+    an optional directory holding one JSON file per result. Results evicted
+    from memory are read back from disk when they are requested again. The
+    directory is not bounded; delete files from it to free space.
+    """
+
+    def __init__(self, maxEntries=256, directory=None):
+        """
+        maxEntries: the number of results kept in memory (an integer)
+        directory: the directory of the disk tier (a string, created if
+        needed), or None to keep results in memory only
+        """
+        self.maxEntries = maxEntries
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return 'ResultCache with '+str(len(self.entries))+' results in memory'
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()+'.json')
+
+    def getMemory(self, key):
+        """
+        Returns the result of key from memory, marking it as recently used,
+        or None if it is not in memory.
+        """
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+        return result
+
+    def getDisk(self, key):
+        """
+        Returns the result of key from the disk tier, or None if it is not
+        there. Blocks on file I/O.
+        """
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key)) as resultFile:
+                entry = json.load(resultFile)
+        except (OSError, ValueError):
+            return None
+        return entry['result'] if entry.get('key') == key else None
+
+    def putMemory(self, key, result):
+        """
+        Stores a result in memory, evicting the least recently used results
+        beyond maxEntries.
+        """
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def putDisk(self, key, result):
+        """
+        Writes a result to the disk tier, if there is one. Blocks on file
+        I/O.
+        """
+        if self.directory is None:
+            return
+        path = self._path(key)
+        with open(path + '.tmp', 'w') as resultFile:
+            json.dump({'key': key, 'result': result}, resultFile)
+        os.replace(path + '.tmp', path)
+
+
+class SimulationService(object):
+    """
+    Runs simulations on a process pool, answering repeated requests from a
+    ResultCache and letting identical concurrent requests share one run.
+    """
+
+    def __init__(self, numWorkers=None, cacheSize=256, cacheDir=None):
+        """
+        numWorkers: the number of worker processes (an integer, or None for
+        one per CPU)
+        cacheSize: the number of results kept in memory (an integer)
+        cacheDir: the directory of the on-disk cache (a string), or None
+        """
+        # imported here, like in virus_simulation.runTrials
+        from concurrent.futures import ProcessPoolExecutor
+        self.pool = ProcessPoolExecutor(max_workers=numWorkers)
+        self.cache = ResultCache(cacheSize, cacheDir)
+        self.inFlight = {}
+        self.stats = {'memoryHits': 0, 'diskHits': 0, 'misses': 0, 'deduplicated': 0,
+                      'uncached': 0}
+
+    def __str__(self):
+        return 'SimulationService with '+str(len(self.inFlight))+' requests in flight'
+
+    async def simulate(self, simulation, params=None, numTrials=100, seed=None):
+        """
+        Returns the result of a simulation, from the cache if possible.
+
+        simulation: 'withoutDrug' or 'withDrug' (a string)
+        params: the simulation parameters (a dictionary, see
+        SIMULATION_PARAMS), or None for the defaults
+        numTrials: the number of trials (an integer)
+        seed: the master seed (an integer), or None for an uncached run with
+        fresh random numbers
+
+        returns: the statistics of the trials (see TrialAggregator.getSummary)
+        """
+        params = makeRequestParams(simulation, params or {})
+        if not _isInteger(numTrials) or numTrials < 1:
+            raise ValueError('numTrials must be a positive integer')
+        if seed is not None and not _isInteger(seed):
+            raise ValueError('seed must be an integer or null')
+        loop = asyncio.get_running_loop()
+        if seed is None:
+            self.stats['uncached'] += 1
+            return await loop.run_in_executor(self.pool, runSimulation, simulation, params,
+                                              numTrials, seed)
+        key = makeRequestKey(simulation, params, numTrials, seed)
+        result = self.cache.getMemory(key)
+        if result is not None:
+            self.stats['memoryHits'] += 1
+            return result
+        task = self.inFlight.get(key)
+        if task is not None:
+            self.stats['deduplicated'] += 1
+        else:
+            task = loop.create_task(self._compute(key, simulation, params, numTrials, seed))
+            self.inFlight[key] = task
+            task.add_done_callback(lambda done: self.inFlight.pop(key, None))
+        # a cancelled request must not cancel the run other requests wait on
+        return await asyncio.shield(task)
+
+    async def _compute(self, key, simulation, params, numTrials, seed):
+        """
+        Reads the result of key from the disk tier, or runs the simulation
+        on the pool and stores its result in both tiers.
+        """
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, self.cache.getDisk, key)
+        if result is not None:
+            self.stats['diskHits'] += 1
+        else:
+            self.stats['misses'] += 1
+            result = await loop.run_in_executor(self.pool, runSimulation, simulation, params,
+                                                numTrials, seed)
+            await loop.run_in_executor(None, self.cache.putDisk, key, result)
+        self.cache.putMemory(key, result)
+        return result
+
+    def close(self):
+        """
+        Shuts down the worker processes.
+        """
+        self.pool.shutdown()
+
+    async def handleConnection(self, reader, writer):
+        """
+        Serves one HTTP request: POST /simulate with a JSON body holding
+        simulation, params, numTrials and seed, or GET /stats.
+        """
+        try:
+            requestLine = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if len(requestLine) < 2:
+                status, response = 400, {'error': 'Malformed request line'}
+            elif requestLine[:2] == ['GET', '/stats']:
+                status, response = 200, dict(self.stats, inFlight=len(self.inFlight))
+            elif requestLine[:2] == ['POST', '/simulate']:
+                try:
+                    request = json.loads(body or b'{}')
+                    status = 200
+                    response = await self.simulate(request.get('simulation', 'withDrug'),
+                                                   request.get('params'),
+                                                   request.get('numTrials', 100),
+                                                   request.get('seed'))
+                except (ValueError, TypeError, KeyError, AttributeError) as error:
+                    status, response = 400, {'error': str(error)}
+            else:
+                status, response = 404, {'error': 'Unknown path: '+' '.join(requestLine[:2])}
+        except Exception as error:
+            status, response = 500, {'error': str(error)}
+        payload = json.dumps(response).encode()
+        writer.write(('HTTP/1.1 '+str(status)+' '+HTTP_REASONS[status]+'\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: '+str(len(payload))+'\r\n'
+                      'Connection: close\r\n\r\n').encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(host='127.0.0.1', port=8765, numWorkers=None, cacheSize=256, cacheDir=None):
+    """
+    Runs the service until it is interrupted.
+    """
+    service = SimulationService(numWorkers, cacheSize, cacheDir)
+    server = await asyncio.start_server(service.handleConnection, host, port)
+    print('Serving simulations on http://'+host+':'+str(port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Virus simulation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='results kept in memory')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the on-disk result cache')
+    options = parser.parse_args()
+    try:
+        asyncio.run(serve(options.host, options.port, options.workers, options.cache_size,
+                          options.cache_dir))
+    except KeyboardInterrupt:
+        pass
@@ -41,8 +41,16 @@ All of the remaining class and function names were provided with docstrings,
 but the implementations are my own work
 """
 
+import csv
+import functools
+import itertools
+import json
+import os
 import random
-import pylab
+import shutil
+import time
+import types
+import numpy as np
 
 
 class NoChildException(Exception):
@@ -50,14 +58,446 @@ class NoChildException(Exception):
     NoChildException is raised by the reproduce() method in the SimpleVirus
     and ResistantVirus classes to indicate that a virus particle does not
     reproduce. You can use NoChildException as is, you do not need to
-    modify/add any code.
+    modify/add any code. The update() methods use the non-raising
+    tryReproduce() instead.
     """
 
+
+class DrugRegistry(object):
+    """
+    Maps drug names to bit positions, so that the resistance profile of a
+    virus particle can be stored as a packed integer. Bit i of a profile is
+    set when the virus is resistant to the i-th registered drug, and the set
+    of drugs a patient takes becomes a single mask.
+    """
+    # profiles must fit in the uint64 arrays used by the array engine
+    MAX_DRUGS = 64
+
+    def __init__(self):
+        """
+        Initializes an empty registry.
+        """
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets every registered drug, e.g. between the independent jobs of a
+        long-lived worker process. Masks and profiles built before no longer
+        mean anything afterwards.
+        """
+        self.positions = {}
+        self.names = []
+        # the interned profiles handed out by getProfile()
+        self.profiles = {}
+        # the trait bits of each traits mask, as handed out by getTraitBits()
+        self.traitOrders = {}
+
+    def getBit(self, drug):
+        """
+        Returns the bit (an integer with a single bit set) assigned to drug,
+        registering drug first if it has not been seen before.
+
+        drug: The drug (a string)
+        """
+        position = self.positions.get(drug)
+        if position is None:
+            if len(self.names) == self.MAX_DRUGS:
+                raise ValueError('Cannot register more than '+str(self.MAX_DRUGS)+' drugs')
+            position = len(self.names)
+            self.positions[drug] = position
+            self.names.append(drug)
+        return 1 << position
+
+    def getMask(self, drugs):
+        """
+        Returns the mask (an integer) with the bits of all drugs in drugs set.
+
+        drugs: the drug names (a list of strings)
+        """
+        mask = 0
+        for drug in drugs:
+            mask |= self.getBit(drug)
+        return mask
+
+    def findMask(self, drugs):
+        """
+        Like getMask(), but without registering anything, for queries about
+        drugs that may never have been seen.
+
+        returns: the mask (an integer), or None if any of drugs is not
+        registered, in which case no virus can be resistant to all of them
+        """
+        mask = 0
+        for drug in drugs:
+            position = self.positions.get(drug)
+            if position is None:
+                return None
+            mask |= 1 << position
+        return mask
+
+    def getTraitBits(self, traits):
+        """
+        Returns the bits set in traits (a tuple of integers) ordered by drug
+        name. Mutations draw one random number per trait in this order, so
+        that a seeded run does not depend on the order in which the process
+        happened to register its drugs.
+        """
+        order = self.traitOrders.get(traits)
+        if order is None:
+            order = tuple(self.getBit(drug) for drug in sorted(self.getDrugs(traits)))
+            self.traitOrders[traits] = order
+        return order
+
+    def getDrugs(self, mask):
+        """
+        Returns the names of the drugs whose bits are set in mask (a list of
+        strings, in registration order).
+        """
+        return [drug for position, drug in enumerate(self.names) if mask >> position & 1]
+
+    def encode(self, resistances):
+        """
+        Packs a resistance dictionary into bits.
+
+        resistances: A dictionary of drug names (strings) mapping to the state
+        of a virus particle's resistance (either True or False) to each drug.
+
+        returns: a tuple (traits, resistant) of masks. traits has a bit set for
+        every key of resistances, resistant for every drug mapped to True.
+        """
+        traits = 0
+        resistant = 0
+        for drug, isResistant in resistances.items():
+            bit = self.getBit(drug)
+            traits |= bit
+            if isResistant:
+                resistant |= bit
+        return traits, resistant
+
+    def decode(self, traits, resistant):
+        """
+        Unpacks the masks returned by encode() into a resistance dictionary.
+        """
+        resistantDrugs = self.getDrugs(resistant)
+        return {drug: drug in resistantDrugs for drug in self.getDrugs(traits)}
+
+    def remap(self, bits, names):
+        """
+        Translates masks built by a registry that registered the drugs in
+        names, e.g. in another process, to the bits of this registry.
+
+        bits: the masks (a numpy uint64 array)
+        names: the drug names of the other registry, in registration order
+        (a list of strings)
+
+        returns: the masks in terms of this registry (bits itself if both
+        registries assign the same bits)
+        """
+        positions = [self.getBit(drug).bit_length() - 1 for drug in names]
+        if positions == list(range(len(names))):
+            return bits
+        remapped = np.zeros_like(bits)
+        for position, newPosition in enumerate(positions):
+            remapped |= (bits >> np.uint64(position) & np.uint64(1)) << np.uint64(newPosition)
+        return remapped
+
+    def getProfile(self, traits, resistant):
+        """
+        Returns the interned, read-only resistance profile for the masks
+        returned by encode(). Every virus with the same masks shares one
+        profile object, which is only built the first time it is asked for;
+        bits are never reassigned, so a profile stays valid as drugs are
+        registered.
+
+        returns: a read-only mapping of drug names (strings) to True or False
+        """
+        key = (traits, resistant)
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = types.MappingProxyType(self.decode(traits, resistant))
+            self.profiles[key] = profile
+        return profile
+
+
+# The registry shared by every virus and patient in this process
+DRUGS = DrugRegistry()
+
+
+class SimulationRNG(object):
+    """
+    The source of every random draw made by a patient and its viruses. Wraps
+    a numpy Generator or a random.Random instance, so that each trial can own
+    a seeded generator instead of sharing the global random module. Single
+    draws are served from a pre-generated block of uniforms, so hot loops
+    do not pay a generator call per decision.
+    """
+
+    def __init__(self, seed=None, generator=None, bufferSize=4096):
+        """
+        Initializes the generator.
+
+        seed: seed for a new numpy Generator (anything numpy.random.default_rng
+        accepts). Ignored if generator is given.
+
+        generator: the generator to wrap (a numpy Generator, a random.Random
+        instance or the random module itself)
+
+        bufferSize: number of uniforms pre-generated per block (an integer).
+        0 disables buffering, so every draw goes straight to the generator.
+        """
+        self.generator = np.random.default_rng(seed) if generator is None else generator
+        self.isNumpy = isinstance(self.generator, np.random.Generator)
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.position = 0
+
+    def _refill(self):
+        """
+        Replaces the buffer with a fresh block of bufferSize uniforms.
+        """
+        if self.isNumpy:
+            self.buffer = self.generator.random(self.bufferSize).tolist()
+        else:
+            self.buffer = [self.generator.random() for i in range(self.bufferSize)]
+        self.position = 0
+
+    def random(self, size=None):
+        """
+        Draws uniforms from [0, 1).
+
+        size: number of draws (an integer), or None for a single draw
+
+        returns: a float if size is None, otherwise a numpy array of size
+        floats
+        """
+        if size is not None:
+            if self.isNumpy:
+                return self.generator.random(size)
+            return np.array([self.generator.random() for i in range(size)], dtype=float)
+        if self.bufferSize == 0:
+            return self.generator.random()
+        if self.position == len(self.buffer):
+            self._refill()
+        self.position += 1
+        return self.buffer[self.position - 1]
+
+    def randomList(self, size):
+        """
+        Draws a block of uniforms from [0, 1) as a list, for loops that make
+        one decision per virus and would otherwise call random() each time.
+
+        size: number of draws (an integer)
+
+        returns: a list of size floats
+        """
+        if self.isNumpy:
+            return self.generator.random(size).tolist()
+        generatorRandom = self.generator.random
+        return [generatorRandom() for i in range(size)]
+
+    def getState(self):
+        """
+        Captures the state of the generator, including the unused part of
+        the buffer, so that a generator rebuilt by fromState() continues with
+        exactly the same draws.
+
+        returns: a tuple (meta, buffer) of a JSON-serializable dictionary
+        and the buffered uniforms (a float array)
+        """
+        if self.isNumpy:
+            state = _jsonState(self.generator.bit_generator.state)
+        else:
+            state = self.generator.getstate()
+        meta = {'isNumpy': self.isNumpy, 'state': state, 'bufferSize': self.bufferSize,
+                'position': self.position,
+                'isGlobal': self.generator is random}
+        return meta, np.array(self.buffer, dtype=float)
+
+    @classmethod
+    def fromState(cls, meta, buffer):
+        """
+        Rebuilds a generator captured by getState(). A generator that drew
+        from the random module restores the module's state and is
+        GLOBAL_RNG again.
+
+        returns: a SimulationRNG
+        """
+        if meta['isNumpy']:
+            state = meta['state']
+            bitGenerator = getattr(np.random, state['bit_generator'])()
+            bitGenerator.state = state
+            rng = cls(generator=np.random.Generator(bitGenerator), bufferSize=meta['bufferSize'])
+        else:
+            state = meta['state']
+            state = (state[0], tuple(state[1]), state[2])
+            if meta['isGlobal']:
+                random.setstate(state)
+                return GLOBAL_RNG
+            generator = random.Random()
+            generator.setstate(state)
+            rng = cls(generator=generator, bufferSize=meta['bufferSize'])
+        rng.buffer = np.asarray(buffer).tolist()
+        rng.position = meta['position']
+        return rng
+
+    def binomial(self, n, p):
+        """
+        Draws binomial variates, element-wise for arrays n and p. Only
+        available on numpy-backed generators.
+        """
+        if not self.isNumpy:
+            raise ValueError('binomial draws need a numpy-backed SimulationRNG')
+        return self.generator.binomial(n, p)
+
+    def poisson(self, lam):
+        """
+        Draws Poisson variates, element-wise for an array lam. Only available
+        on numpy-backed generators.
+        """
+        if not self.isNumpy:
+            raise ValueError('poisson draws need a numpy-backed SimulationRNG')
+        return self.generator.poisson(lam)
+
+
+def _jsonState(state):
+    """
+    Returns a copy of a numpy bit generator state with its arrays turned
+    into lists, so that it can be written as JSON.
+    """
+    if isinstance(state, dict):
+        return {key: _jsonState(value) for key, value in state.items()}
+    if isinstance(state, np.ndarray):
+        return state.tolist()
+    return state
+
+
+# The generator used by viruses and patients that are not given one. It
+# draws straight from the random module, so random.seed() still applies.
+GLOBAL_RNG = SimulationRNG(generator=random, bufferSize=0)
+
+
+class Instrumentation(object):
+    """
+    Opt-in profiling of the update loop of a Patient or TreatedPatient.
+    Records how long each phase of update() and getResistPop() takes, how
+    many births, clearances and mutations each step had, and calls observers
+    after every step. A patient without instrumentation pays a single
+    attribute check per update() or getResistPop() call.
+    """
+    PHASES = ('clearance', 'density', 'reproduction', 'getResistPop')
+
+    def __init__(self, trace=False):
+        """
+        Initializes empty timers and counters.
+
+        trace: whether to keep a timed event for every phase of every step,
+        for writeTrace() (a boolean). Without it only the totals are kept.
+        """
+        self.phaseTimes = {phase: 0.0 for phase in self.PHASES}
+        self.phaseCalls = {phase: 0 for phase in self.PHASES}
+        self.steps = []
+        self.observers = []
+        self.trace = trace
+        self.events = []
+
+    def __str__(self):
+        return 'Instrumentation of '+str(len(self.steps))+' steps'
+
+    def addObserver(self, observer):
+        """
+        Registers a function to call after every step.
+
+        observer: a function taking the patient and the record of the step
+        (a dictionary, see endStep())
+        """
+        self.observers.append(observer)
+
+    def removeObserver(self, observer):
+        """
+        Stops calling observer after every step.
+        """
+        self.observers.remove(observer)
+
+    def recordPhase(self, phase, start):
+        """
+        Adds the time since start to phase.
+
+        phase: the name of the phase (one of PHASES)
+
+        start: the time the phase started (a time.perf_counter() value)
+
+        returns: the time the phase ended, which is where the next phase
+        starts
+        """
+        end = time.perf_counter()
+        self.phaseTimes[phase] += end - start
+        self.phaseCalls[phase] += 1
+        if self.trace:
+            self.events.append((phase, start, end - start))
+        return end
+
+    def endStep(self, patient, start, births, clearances, mutations):
+        """
+        Records one update() step and calls the observers.
+
+        patient: the patient that was updated
+
+        start: the time the step started (a time.perf_counter() value)
+
+        births, clearances, mutations: the number of children born, of
+        viruses cleared and of resistance traits flipped in the children
+        during the step (integers)
+        """
+        duration = time.perf_counter() - start
+        record = {'step': len(self.steps), 'births': births, 'clearances': clearances,
+                  'mutations': mutations, 'population': patient.getTotalPop(),
+                  'time': duration}
+        self.steps.append(record)
+        if self.trace:
+            self.events.append(('update', start, duration))
+        for observer in self.observers:
+            observer(patient, record)
+
+    def getSummary(self):
+        """
+        Returns the totals over all recorded steps (a dictionary): the
+        number of steps, the total births, clearances and mutations, and the
+        total seconds and number of calls per phase.
+        """
+        return {'steps': len(self.steps),
+                'births': sum(record['births'] for record in self.steps),
+                'clearances': sum(record['clearances'] for record in self.steps),
+                'mutations': sum(record['mutations'] for record in self.steps),
+                'phaseTimes': dict(self.phaseTimes),
+                'phaseCalls': dict(self.phaseCalls)}
+
+    def writeTrace(self, path):
+        """
+        Writes the recorded events in the Chrome trace event format, which
+        chrome://tracing, Perfetto and speedscope display as a flame graph:
+        the phases of each step are nested under its update event. Needs
+        trace=True.
+
+        path: the JSON file to write (a string)
+        """
+        if not self.trace:
+            raise ValueError('writeTrace needs Instrumentation(trace=True)')
+        origin = min(start for name, start, duration in self.events) if self.events else 0.0
+        events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                   'ts': (start - origin) * 1e6, 'dur': duration * 1e6}
+                  for name, start, duration in self.events]
+        with open(path, 'w') as traceFile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+
 class SimpleVirus(object):
 
     """
     Representation of a simple virus (does not model drug effects/resistance).
     """
+    # no per-instance __dict__: the object engine keeps one instance per
+    # virus particle, so the attribute storage dominates its memory use
+    __slots__ = ('maxBirthProb', 'clearProb')
+
     def __init__(self, maxBirthProb, clearProb):
         """
         Initialize a SimpleVirus instance, saves all parameters as attributes
@@ -83,15 +523,18 @@ class SimpleVirus(object):
         """
         return self.clearProb
 
-    def doesClear(self):
+    def doesClear(self, rng=None):
         """ Stochastically determines whether this virus particle is cleared from the
         patient's body at a time step. 
-        returns: True with probability self.getClearProb and otherwise returns
+        rng: the generator to draw from (a SimulationRNG, GLOBAL_RNG if None)
+        returns: True with probability self.clearProb and otherwise returns
         False.
         """
-        return random.random() < self.getClearProb()
+        if rng is None:
+            rng = GLOBAL_RNG
+        return rng.random() < self.clearProb
     
-    def reproduce(self, popDensity):
+    def reproduce(self, popDensity, rng=None):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the Patient and
@@ -104,16 +547,40 @@ class SimpleVirus(object):
 
         popDensity: the population density (a float), defined as the current
         virus population divided by the maximum population.         
+
+        rng: the generator to draw from (a SimulationRNG, GLOBAL_RNG if None)
         
         returns: a new instance of the SimpleVirus class representing the
         offspring of this virus particle. The child should have the same
         maxBirthProb and clearProb values as this virus. Raises a
         NoChildException if this virus particle does not reproduce.               
         """
-        if random.random() < self.maxBirthProb*(1-popDensity):
-            return SimpleVirus(self.maxBirthProb, self.clearProb)
-        else:
+        child = self.tryReproduce(popDensity, rng)
+        if child is None:
             raise NoChildException
+        return child
+
+    def tryReproduce(self, popDensity, rng=None, draw=None):
+        """
+        Non-raising version of reproduce(). Nearly every virus particle fails
+        to reproduce once the population nears maxPop, and returning None is
+        far cheaper than raising and catching a NoChildException.
+
+        popDensity: the population density (a float)
+
+        rng: the generator to draw from (a SimulationRNG, GLOBAL_RNG if None)
+
+        draw: the uniform that decides whether the virus reproduces (a float,
+        as drawn in a block by Patient.update()), or None to draw it from rng
+
+        returns: a new instance of the SimpleVirus class representing the
+        offspring of this virus particle, or None if it does not reproduce.
+        """
+        if draw is None:
+            draw = (GLOBAL_RNG if rng is None else rng).random()
+        if draw < self.maxBirthProb*(1-popDensity):
+            return SimpleVirus(self.maxBirthProb, self.clearProb)
+        return None
 
 
 class Patient(object):
@@ -122,7 +589,7 @@ class Patient(object):
     and his/her virus populations have no drug resistance.
     """    
 
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes.
@@ -131,9 +598,14 @@ class Patient(object):
         SimpleVirus instances)
 
         maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the generator every random draw of this patient and its viruses
+        is taken from (a SimulationRNG, GLOBAL_RNG if None)
         """
         self.viruses = viruses
         self.maxPop = maxPop
+        self.rng = GLOBAL_RNG if rng is None else rng
+        self.instrumentation = None
 
     def __str__(self):
         return 'Patient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
@@ -160,6 +632,63 @@ class Patient(object):
         return len(self.getViruses())        
 
 
+    def getState(self):
+        """
+        Captures the state of the virus population for a snapshot (see
+        saveSnapshot).
+
+        returns: a tuple (meta, arrays) of a JSON-serializable dictionary
+        and a dictionary of named numpy arrays
+        """
+        return ({'maxPop': self.maxPop},
+                {'maxBirthProbs': np.array([virus.maxBirthProb for virus in self.viruses],
+                                           dtype=float),
+                 'clearProbs': np.array([virus.clearProb for virus in self.viruses],
+                                        dtype=float)})
+
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        """
+        Rebuilds a patient captured by getState(), with the viruses in the
+        same order.
+
+        rng: the generator the patient draws from (a SimulationRNG)
+
+        returns: a new instance of this class
+        """
+        viruses = [SimpleVirus(maxBirthProb, clearProb) for maxBirthProb, clearProb
+                   in zip(arrays['maxBirthProbs'].tolist(), arrays['clearProbs'].tolist())]
+        return cls(viruses, meta['maxPop'], rng)
+
+
+    def startInstrumentation(self, instrumentation=None):
+        """
+        Starts profiling update() and getResistPop().
+
+        instrumentation: the Instrumentation to record into, so that several
+        patients can share one (a new one if None)
+
+        returns: the Instrumentation
+        """
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        return instrumentation
+
+
+    def stopInstrumentation(self):
+        """
+        Stops profiling, so update() runs at full speed again.
+
+        returns: the Instrumentation that was recording (None if there was
+        none)
+        """
+        instrumentation = self.instrumentation
+        self.instrumentation = None
+        return instrumentation
+
+
     def update(self):
         """
         Update the state of the virus population in this patient for a single
@@ -178,20 +707,174 @@ class Patient(object):
         returns: The total virus population at the end of the update (an
         integer)
         """
-        for virus in self.getViruses():
-            if virus.doesClear():
-                self.viruses.remove(virus)
+        if self.instrumentation is not None:
+            return self._instrumentedUpdate()
+        self._clearViruses()
         popDensity = len(self.getViruses()) / self.getMaxPop()
-        for virus in self.getViruses():
-            try:
-                self.viruses.append(virus.reproduce(popDensity))
-            except NoChildException:
-                pass
+        self.viruses.extend(self._reproduceViruses(popDensity))
+        return len(self.getViruses())
+
+
+    def _instrumentedUpdate(self):
+        """
+        update() with every phase timed and counted by self.instrumentation.
+        Both run the same phase methods, so they cannot drift apart.
+        """
+        instrumentation = self.instrumentation
+        start = phaseStart = time.perf_counter()
+        clearances = self._clearViruses()
+        phaseStart = instrumentation.recordPhase('clearance', phaseStart)
+        popDensity = len(self.getViruses()) / self.getMaxPop()
+        phaseStart = instrumentation.recordPhase('density', phaseStart)
+        parents = []
+        children = self._reproduceViruses(popDensity, parents)
+        self.viruses.extend(children)
+        instrumentation.recordPhase('reproduction', phaseStart)
+        instrumentation.endStep(self, start, len(children), clearances,
+                                self._countMutations(children, parents))
         return len(self.getViruses())
 
 
+    def _clearViruses(self):
+        """
+        The clearance phase of update(): removes the viruses that are
+        cleared at this time step.
+
+        returns: the number of viruses cleared (an integer)
+        """
+        numViruses = len(self.viruses)
+        # a single filtering pass gives every virus exactly one clearance
+        # check; slice assignment keeps the caller's list object. Each phase
+        # draws one block of uniforms instead of one generator call per virus.
+        draws = self.rng.randomList(numViruses)
+        self.viruses[:] = [virus for virus, draw in zip(self.viruses, draws)
+                           if draw >= virus.clearProb]
+        return numViruses - len(self.viruses)
+
+
+    def _reproduceViruses(self, popDensity, parents=None):
+        """
+        The reproduction phase of update(): draws the offspring of every
+        virus, without adding them to the patient.
+
+        popDensity: the population density (a float)
+
+        parents: a list that the parent of each child is appended to, or None
+
+        returns: the list of offspring
+        """
+        children = []
+        rng = self.rng
+        for virus, draw in zip(self.viruses, rng.randomList(len(self.viruses))):
+            child = virus.tryReproduce(popDensity, rng, draw)
+            if child is not None:
+                children.append(child)
+                if parents is not None:
+                    parents.append(virus)
+        return children
+
+
+    def _countMutations(self, children, parents):
+        """
+        Returns the number of resistance traits that differ between children
+        and their parents (an integer). A SimpleVirus has none.
+        """
+        return 0
+
+
+# The names of the series returned by runTrialWithoutDrug
+SERIES_WITHOUT_DRUG = ('total',)
+# The largest drift between the two halves of a steady-state window,
+# relative to the population
+STEADY_STATE_TOLERANCE = 0.005
+
+def _steadyStateMeans(series, window, tolerance=STEADY_STATE_TOLERANCE):
+    """
+    Tests whether the last window values of every series have settled: the
+    means of the two halves of the window differ by at most tolerance times
+    the larger of the two, for each series on its own. A small series such
+    as a slowly growing resistant population therefore keeps the trial
+    from settling even when the total population has.
+
+    series: the per-timestep values of a trial so far (a tuple of lists)
+    window: the number of timesteps to look at (an integer)
+
+    returns: the mean of the window for each series (a list of integers),
+    or None if the trial has not settled
+    """
+    half = window // 2
+    firstMeans = [sum(values[-window:-half]) / (window - half) for values in series]
+    secondMeans = [sum(values[-half:]) / half for values in series]
+    for first, second in zip(firstMeans, secondMeans):
+        if abs(second - first) > tolerance * max(first, second):
+            return None
+    return [int(round(sum(values[-window:]) / window)) for values in series]
+
+def _checkSteadyStateWindow(window):
+    """
+    Raises a ValueError unless window is None or a steady-state window of at
+    least 2 timesteps, which _steadyStateMeans needs to compare two halves.
+    """
+    if window is not None and window < 2:
+        raise ValueError('steadyStateWindow must be at least 2 timesteps: '+str(window))
+
+def runTrialWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
+                        engine='object', seed=None, checkpointDir=None,
+                        checkpointEvery=100, steadyStateWindow=None):
+    """
+    Runs a single simulationWithoutDrug trial: instantiates a patient and
+    updates it for 300 timesteps.
+
+    seed: the seed of this trial (a numpy SeedSequence, as returned by
+    makeTrialSeeds), or None for an unseeded trial
+    checkpointDir: the snapshot directory of this trial (a string, see
+    saveSnapshot), or None for no checkpoints. If it holds a snapshot, the
+    trial resumes from it and gives exactly the results of an
+    uninterrupted run.
+    checkpointEvery: the number of timesteps between snapshots (an integer)
+    steadyStateWindow: the number of timesteps (an integer, at least 2) over
+    which the population must settle (see _steadyStateMeans) before the rest
+    of the trial is filled with its mean instead of simulated, or None to
+    simulate every timestep. This trades the fluctuations of the skipped timesteps
+    for speed.
+
+    A population that dies out stays at 0, so an extinct trial fills its
+    remaining timesteps with 0 without updating the patient.
+
+    returns: a tuple holding the list of total virus populations after each
+    timestep
+    """
+    _checkSteadyStateWindow(steadyStateWindow)
+    if checkpointDir is not None and os.path.exists(checkpointDir):
+        patient, start, stats = loadSnapshot(checkpointDir)
+        virusPop = stats['total']
+    else:
+        rng = seedTrial(seed)
+        patient = makePatient(engine, numViruses, maxPop, maxBirthProb, clearProb, rng)
+        start = 0
+        virusPop = []
+    for timestep in range(start, 300):
+        patient.update()
+        virusPop.append(patient.getTotalPop())
+        if virusPop[-1] == 0:
+            virusPop.extend([0] * (299 - timestep))
+            break
+        # the window looks at the whole history, so a resumed trial makes
+        # the same decisions as an uninterrupted one
+        if steadyStateWindow is not None and timestep + 1 >= steadyStateWindow:
+            means = _steadyStateMeans((virusPop,), steadyStateWindow)
+            if means is not None:
+                virusPop.extend(means * (299 - timestep))
+                break
+        if checkpointDir is not None and (timestep + 1) % checkpointEvery == 0:
+            saveSnapshot(checkpointDir, patient, timestep + 1, {'total': virusPop})
+    return (virusPop,)
+
+
 def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
-                          numTrials):
+                          numTrials, engine='object', numWorkers=1, seed=None,
+                          sink=None, plot=True, aggregator=None,
+                          steadyStateWindow=None):
     """   
     For each of numTrials trial, instantiates a patient, runs a simulation
     for 300 timesteps, and plots the average virus population size as a
@@ -202,47 +885,56 @@ def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
     maxBirthProb: Maximum reproduction probability (a float between 0-1)        
     clearProb: Maximum clearance probability (a float between 0-1)
     numTrials: number of simulation runs to execute (an integer)
+    engine: which population engine to use (a string, one of ENGINES).
+    'object' keeps one SimpleVirus per particle, 'array' uses ArrayPatient,
+    'count' uses CountPatient and 'tau' or 'tau:<tolerance>' uses the
+    approximate TauLeapPatient.
+    numWorkers: number of worker processes to spread the trials over (an
+    integer, see runTrials)
+    seed: master seed for the trials (an integer), or None for unseeded runs
+    sink: where to stream the per-trial results as they arrive (a
+    ResultsSink with the series 'total'), or None
+    plot: whether to plot the averages (a boolean). Headless runs pass False,
+    which never imports virus_reporting or pylab.
+    aggregator: a TrialAggregator to collect the per-timestep variance and
+    quantiles in, or None. The plot then shows the 5-95% band.
+    steadyStateWindow: fast-forward settled trials (see runTrialWithoutDrug),
+    or None to simulate every timestep
+
+    returns: the list of average total virus populations per timestep
     """
 
-    trialCounter = 0
-    virusPop = []
-    for trial in range(numTrials):
-        trialCounter += 1
-        viruses = []
-        for num in range(numViruses):
-            viruses.append(SimpleVirus(maxBirthProb, clearProb))
-        patient = Patient(viruses, maxPop)
-
-        timesteps = []
-        counter = 0
-        if trialCounter == 1:
-            for timestep in range(300):
-                counter += 1
-                timesteps.append(counter)
-                patient.update()
-                virusPop.append(patient.getTotalPop())
-        else:
-            for timestep in range(300):
-                counter += 1
-                timesteps.append(counter)
-                patient.update()
-                virusPop[counter-1] += patient.getTotalPop()
+    _checkSteadyStateWindow(steadyStateWindow)
+    if sink is not None:
+        sink.open(SERIES_WITHOUT_DRUG)
+    if aggregator is not None and aggregator.seriesNames is None:
+        aggregator.seriesNames = SERIES_WITHOUT_DRUG
+    virusPop, = runTrials(functools.partial(runTrialWithoutDrug,
+                                            steadyStateWindow=steadyStateWindow),
+                          (numViruses, maxPop, maxBirthProb, clearProb, engine),
+                          numTrials, numWorkers, seed, sink, aggregator).tolist()
+    if sink is not None:
+        sink.close()
     virusPopAvg = []
     for item in virusPop:
         virusPopAvg.append(item/numTrials)
   
-    pylab.plot(virusPopAvg, label = 'SimpleVirus')    
-    pylab.title('SimpleVirus simulation')
-    pylab.xlabel('Time Steps')
-    pylab.ylabel('Average Virus Population')
-    pylab.legend(loc = 'best')
-    pylab.show()
+    if plot:
+        import virus_reporting
+        bands = None
+        if aggregator is not None:
+            bands = {'SimpleVirus': (aggregator.getQuantile(0.05)[0].tolist(),
+                                     aggregator.getQuantile(0.95)[0].tolist())}
+        virus_reporting.plotAverages({'SimpleVirus': virusPopAvg}, 'SimpleVirus simulation',
+                                     bands)
+    return virusPopAvg
 
 
 class ResistantVirus(SimpleVirus):
     """
     Representation of a virus which can have drug resistance.
     """   
+    __slots__ = ('traitBits', 'resistBits', 'mutProb')
 
     def __init__(self, maxBirthProb, clearProb, resistances, mutProb):
         """
@@ -262,26 +954,28 @@ class ResistantVirus(SimpleVirus):
         the probability of the offspring acquiring or losing resistance to a drug.
         """
         SimpleVirus.__init__(self, maxBirthProb, clearProb)
-        self.maxBirthProb = maxBirthProb
-        self.clearProb = clearProb
-        self.resistances = resistances
+        # resistances are stored as DRUGS bit masks rather than as a dict
+        self.traitBits, self.resistBits = DRUGS.encode(resistances)
         self.mutProb = mutProb
         
     def __str__(self):
-        return 'Resistant Virus with maxBirthProb:'+str(self.maxBirthProb)+' , clearProb:'+str(self.clearProb)+' ,resistances:'+str(self.getResistances())+' ,mutProb:'+str(self.mutProb)
+        return 'Resistant Virus with maxBirthProb:'+str(self.maxBirthProb)+' , clearProb:'+str(self.clearProb)+' ,resistances:'+str(dict(self.getResistances()))+' ,mutProb:'+str(self.mutProb)
         
 
     def getResistances(self):
         """
-        Returns the resistances for this virus.
+        Returns the resistances for this virus: a read-only mapping of drug
+        names to True or False, shared with every virus that has the same
+        resistance profile. Use dict(virus.getResistances()) for a copy that
+        can be changed.
         """
-        return self.resistances
+        return DRUGS.getProfile(self.traitBits, self.resistBits)
 
     def getMutProb(self):
         """
         Returns the mutation probability for this virus.
         """
-        return self.getMutProb
+        return self.mutProb
 
     def isResistantTo(self, drug):
         """
@@ -294,10 +988,11 @@ class ResistantVirus(SimpleVirus):
         returns: True if this virus instance is resistant to the drug, False
         otherwise.
         """
-        return self.getResistances().get(drug)
+        bit = DRUGS.findMask([drug])
+        return bit is not None and self.resistBits & bit != 0
 
 
-    def reproduce(self, popDensity, activeDrugs):
+    def reproduce(self, popDensity, activeDrugs, rng=None):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the TreatedPatient class.
@@ -334,63 +1029,71 @@ class ResistantVirus(SimpleVirus):
         virus population divided by the maximum population       
 
         activeDrugs: a list of the drug names acting on this virus particle
-        (a list of strings).
+        (a list of strings), or the DRUGS mask of those drugs (an integer).
+
+        rng: the generator to draw from (a SimulationRNG, GLOBAL_RNG if None)
 
         returns: a new instance of the ResistantVirus class representing the
         offspring of this virus particle. The child should have the same
         maxBirthProb and clearProb values as this virus. Raises a
         NoChildException if this virus particle does not reproduce.
         """
-        for drug in activeDrugs:  # check if virus resistant to all activeDrugs
-            if self.isResistantTo(drug):
-                continue
-            else:
-                raise NoChildException 
-        if random.random() < self.maxBirthProb * (1 - popDensity):
-            resistanceKeys = self.getResistances().keys()
-            resistanceValues = self.getResistances().values()
-            for drug in resistanceKeys:
-                if random.random() < 1-self.mutProb:
-                    if self.resistances[drug] == True:    
-                        self.resistances[drug] = True
-                    else:
-                        self.resistances[drug] = False
-                else:
-                    if self.resistances[drug] == False:
-                        self.resistances[drug] = True
-                    else:
-                        self.resistances[drug] = False
-        else:
+        child = self.tryReproduce(popDensity, activeDrugs, rng)
+        if child is None:
             raise NoChildException
-        
-        return ResistantVirus(self.maxBirthProb, self.clearProb, self.resistances, self.mutProb)
-            
-
-class TreatedPatient(Patient):
-    """
-    Representation of a patient. The patient is able to take drugs and his/her
-    virus population can acquire resistance to the drugs he/she takes.
-    """
+        return child
 
-    def __init__(self, viruses, maxPop):
+    def tryReproduce(self, popDensity, activeDrugs, rng=None, draw=None):
         """
-        Initialization function, saves the viruses and maxPop parameters as
-        attributes. Also initializes the list of drugs being administered
-        (which should initially include no drugs).              
+        Non-raising version of reproduce(), used by TreatedPatient.update().
 
-        viruses: The list representing the virus population (a list of
-        virus instances)
+        popDensity: the population density (a float)
 
-        maxPop: The  maximum virus population for this patient (an integer)
+        activeDrugs: the drugs acting on this virus particle (a list of
+        strings, or their DRUGS mask as an integer)
+
+        rng: the generator to draw from (a SimulationRNG, GLOBAL_RNG if None).
+        Mutations are always drawn from it.
+
+        draw: the uniform that decides whether the virus reproduces (a float,
+        as drawn in a block by TreatedPatient.update()), or None to draw it
+        from rng
+
+        returns: a new instance of the ResistantVirus class representing the
+        offspring of this virus particle, or None if it does not reproduce.
         """
-        Patient.__init__(self, viruses, maxPop)
-        self.viruses = viruses
-        self.maxPop = maxPop
-        self.drugs = []
+        if not isinstance(activeDrugs, int):
+            activeDrugs = DRUGS.findMask(activeDrugs)
+            if activeDrugs is None:     # no virus is resistant to an unknown drug
+                return None
+        if self.resistBits & activeDrugs != activeDrugs:  # not resistant to all activeDrugs
+            return None
+        if rng is None:
+            rng = GLOBAL_RNG
+        if draw is None:
+            draw = rng.random()
+        if draw >= self.maxBirthProb * (1 - popDensity):
+            return None
+        childBits = self.resistBits
+        for bit in DRUGS.getTraitBits(self.traitBits):
+            if rng.random() < self.mutProb:
+                childBits ^= bit
+
+        child = ResistantVirus.__new__(type(self))
+        child.maxBirthProb = self.maxBirthProb
+        child.clearProb = self.clearProb
+        child.traitBits = self.traitBits
+        child.resistBits = childBits
+        child.mutProb = self.mutProb
+        return child
+            
 
-    def __str__(self):
-        return 'TreatedPatient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
-    
+class PrescriptionsMixin(object):
+    """
+    The prescription methods shared by every treated patient class. The class
+    keeps the prescribed drug names in self.drugs and their DRUGS mask in
+    self.activeMask.
+    """
 
     def addPrescription(self, newDrug):
         """
@@ -404,53 +1107,186 @@ class TreatedPatient(Patient):
         """
         if newDrug not in self.drugs:
             self.drugs.append(newDrug)
+            self._prescriptionsChanged()
 
 
-    def getPrescriptions(self):
+    def removePrescription(self, drug):
         """
-        Returns the drugs that are being administered to this patient.
+        Stop administering a drug to this patient. If the drug is not
+        prescribed to this patient, the method has no effect.
 
-        returns: The list of drug names (strings) being administered to this
-        patient.
+        drug: The name of the drug to stop (a string).
         """
-        return self.drugs
-        
+        if drug in self.drugs:
+            self.drugs.remove(drug)
+            self._prescriptionsChanged()
 
 
-    def getResistPop(self, drugResist):
+    def setPrescriptions(self, drugs):
         """
-        Get the population of virus particles resistant to the drugs listed in
-        drugResist.       
-
-        drugResist: Which drug resistances to include in the population (a list
-        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+        Replaces the drugs being administered to this patient, as a dosing
+        schedule does at each change of regimen.
 
-        returns: The population of viruses (an integer) with resistances to all
-        drugs in the drugResist list.
+        drugs: The drug names (a list or tuple of strings).
         """
-        resistantPop = 0
-        for virus in self.viruses:
-            numDrugsResistant = 0
-            for drug in drugResist:
-                if virus.isResistantTo(drug):
-                    numDrugsResistant += 1
-            if numDrugsResistant == len(drugResist):
-                resistantPop += 1
-        return resistantPop
+        self.drugs = list(drugs)
+        self._prescriptionsChanged()
 
 
-    def update(self):
+    def _prescriptionsChanged(self):
         """
-        Update the state of the virus population in this patient for a single
-        time step. update() executes these actions in order:
-
-        - Determine whether each virus particle survives and update the list of
-          virus particles accordingly
+        Recomputes activeMask, the DRUGS mask of the prescribed drugs, which
+        update() hands to every virus instead of the list of drug names. The
+        prescriptions must only be changed through the methods above.
+        """
+        self.activeMask = DRUGS.getMask(self.drugs)
 
-        - The current population density is calculated. This population density
-          value is used until the next call to update().
 
-        - Based on this value of population density, determine whether each 
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+
+        returns: The list of drug names (strings) being administered to this
+        patient.
+        """
+        return self.drugs
+
+
+def _restorePrescriptions(patient, meta):
+    """
+    Restores the prescriptions saved in a snapshot of a treated patient,
+    without the side effects of setPrescriptions() (such as ending a tau
+    leap).
+    """
+    patient.drugs = list(meta['drugs'])
+    patient.activeMask = DRUGS.getMask(patient.drugs)
+
+
+class TreatedPatient(PrescriptionsMixin, Patient):
+    """
+    Representation of a patient. The patient is able to take drugs and his/her
+    virus population can acquire resistance to the drugs he/she takes.
+    """
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, saves the viruses and maxPop parameters as
+        attributes. Also initializes the list of drugs being administered
+        (which should initially include no drugs).              
+
+        viruses: The list representing the virus population (a list of
+        virus instances)
+
+        maxPop: The  maximum virus population for this patient (an integer)
+
+        rng: the generator every random draw of this patient and its viruses
+        is taken from (a SimulationRNG, GLOBAL_RNG if None)
+        """
+        Patient.__init__(self, viruses, maxPop, rng)
+        self.viruses = viruses
+        self.maxPop = maxPop
+        self.drugs = []
+        self.activeMask = 0
+        # number of viruses per resistance profile (resistBits), kept up to
+        # date by update() so getResistPop() never scans the viruses
+        self.profileCounts = {}
+        for virus in viruses:
+            self.profileCounts[virus.resistBits] = self.profileCounts.get(virus.resistBits, 0) + 1
+        # set checkCounts to True to verify profileCounts against a full scan
+        # on every getResistPop() call
+        self.checkCounts = False
+
+    def __str__(self):
+        return 'TreatedPatient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
+    
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.       
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        if self.instrumentation is not None:
+            start = time.perf_counter()
+        if self.checkCounts:
+            self.checkProfileCounts()
+        mask = DRUGS.findMask(drugResist)
+        resistantPop = 0
+        if mask is not None:    # no virus is resistant to an unknown drug
+            for profile, count in self.profileCounts.items():
+                if profile & mask == mask:
+                    resistantPop += count
+        if self.instrumentation is not None:
+            self.instrumentation.recordPhase('getResistPop', start)
+        return resistantPop
+
+
+    def checkProfileCounts(self):
+        """
+        Recounts the resistance profiles of all viruses and checks them
+        against the incrementally maintained profileCounts. The counts only
+        stay correct if the virus list is changed through update(), so this
+        is meant for tests and debugging.
+
+        Raises an AssertionError if the counts differ.
+        """
+        profileCounts = {}
+        for virus in self.viruses:
+            profileCounts[virus.resistBits] = profileCounts.get(virus.resistBits, 0) + 1
+        if profileCounts != self.profileCounts:
+            raise AssertionError('Resistance profile counts are out of date: '
+                                 +str(self.profileCounts)+' != '+str(profileCounts))
+
+
+    def getState(self):
+        meta, arrays = Patient.getState(self)
+        meta['drugs'] = list(self.drugs)
+        meta['checkCounts'] = self.checkCounts
+        arrays['traitBits'] = np.array([virus.traitBits for virus in self.viruses],
+                                       dtype=np.uint64)
+        arrays['resistBits'] = np.array([virus.resistBits for virus in self.viruses],
+                                        dtype=np.uint64)
+        arrays['mutProbs'] = np.array([virus.mutProb for virus in self.viruses], dtype=float)
+        return meta, arrays
+
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        viruses = []
+        for maxBirthProb, clearProb, traits, resistant, mutProb in zip(
+                arrays['maxBirthProbs'].tolist(), arrays['clearProbs'].tolist(),
+                arrays['traitBits'].tolist(), arrays['resistBits'].tolist(),
+                arrays['mutProbs'].tolist()):
+            virus = ResistantVirus.__new__(ResistantVirus)
+            virus.maxBirthProb = maxBirthProb
+            virus.clearProb = clearProb
+            virus.traitBits = traits
+            virus.resistBits = resistant
+            virus.mutProb = mutProb
+            viruses.append(virus)
+        patient = cls(viruses, meta['maxPop'], rng)
+        _restorePrescriptions(patient, meta)
+        patient.checkCounts = meta['checkCounts']
+        return patient
+
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step. update() executes these actions in order:
+
+        - Determine whether each virus particle survives and update the list of
+          virus particles accordingly
+
+        - The current population density is calculated. This population density
+          value is used until the next call to update().
+
+        - Based on this value of population density, determine whether each 
           virus particle should reproduce and add offspring virus particles to 
           the list of viruses in this patient.
           The list of drugs being administered should be accounted for in the
@@ -459,30 +1295,350 @@ class TreatedPatient(Patient):
         returns: The total virus population at the end of the update (an
         integer)
         """
-        activeDrugs = self.getPrescriptions()
+        return Patient.update(self)
+
+
+    def _clearViruses(self):
+        """
+        The clearance phase of update(), which also takes the cleared viruses
+        out of profileCounts.
+
+        returns: the number of viruses cleared (an integer)
+        """
+        profileCounts = self.profileCounts
+        survivors = []
+        # a single filtering pass gives every virus exactly one clearance
+        # check; slice assignment keeps the caller's list object
+        for virus, draw in zip(self.viruses, self.rng.randomList(len(self.viruses))):
+            if draw < virus.clearProb:
+                profileCounts[virus.resistBits] -= 1
+            else:
+                survivors.append(virus)
+        clearances = len(self.viruses) - len(survivors)
+        self.viruses[:] = survivors
+        return clearances
+
+
+    def _reproduceViruses(self, popDensity, parents=None):
+        """
+        The reproduction phase of update(), under the prescribed drugs. The
+        offspring are counted in profileCounts, and profiles left without
+        viruses are dropped from it.
+
+        returns: the list of offspring (see Patient._reproduceViruses)
+        """
+        activeDrugs = self.activeMask
+        profileCounts = self.profileCounts
         children = []
-        for virus in self.getViruses():
-            if virus.doesClear():
-                self.viruses.remove(virus)
-        popDensity = len(self.getViruses()) / self.getMaxPop()
-        for virus in self.getViruses():
-            try:
-                children.append(virus.reproduce(popDensity,activeDrugs))
-            except NoChildException:
-                pass
-        for child in children:
-            self.viruses.append(child)
-        return len(self.getViruses())
+        rng = self.rng
+        for virus, draw in zip(self.viruses, rng.randomList(len(self.viruses))):
+            child = virus.tryReproduce(popDensity, activeDrugs, rng, draw)
+            if child is not None:
+                children.append(child)
+                profileCounts[child.resistBits] = profileCounts.get(child.resistBits, 0) + 1
+                if parents is not None:
+                    parents.append(virus)
+        for profile in [profile for profile, count in profileCounts.items() if count == 0]:
+            del profileCounts[profile]
+        return children
+
+
+    def _countMutations(self, children, parents):
+        """
+        Returns the number of resistance traits that differ between children
+        and their parents (an integer).
+        """
+        return sum(bin(child.resistBits ^ parent.resistBits).count('1')
+                   for child, parent in zip(children, parents))
+
+
+class DosingSchedule(object):
+    """
+    Representation of a dosing schedule: which drugs a TreatedPatient takes
+    at each time step. A schedule is built from drug on/off events at
+    arbitrary time steps and from repeating regimens, and is turned into the
+    set of active drugs per step once, before a trial starts.
+
+    An event at timestep t takes effect before the t-th update (counting
+    from 0), so a drug started at timestep 150 acts on update 150 onwards.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty schedule, in which no drug is ever taken.
+        """
+        self.events = []
+        self.regimens = []
+        # the number of events added before each regimen, so that events
+        # and regimens can be applied in the order they were added
+        self.regimenPositions = []
+
+    def __str__(self):
+        return 'DosingSchedule with events:'+str(self.events)+' and regimens:'+str(self.regimens)
+
+    def addEvent(self, timestep, drug, isActive):
+        """
+        Starts or stops a drug at a time step. Events at the same time step
+        apply in the order they were added.
+
+        timestep: the time step of the event (a non-negative integer)
+        drug: the name of the drug (a string)
+        isActive: True to start the drug, False to stop it
+        """
+        if timestep < 0:
+            raise ValueError('Cannot schedule an event before timestep 0: '+str(timestep))
+        self.events.append((timestep, drug, isActive))
+
+    def addDose(self, drug, start, stop=None):
+        """
+        Administers a drug from timestep start until timestep stop.
+
+        drug: the name of the drug (a string)
+        start: the first time step the drug acts on (an integer)
+        stop: the first time step the drug no longer acts on (an integer), or
+        None to keep administering it until the end of the trial
+        """
+        self.addEvent(start, drug, True)
+        if stop is not None:
+            self.addEvent(stop, drug, False)
+
+    def addRegimen(self, drug, start, onSteps, offSteps, numCycles=None):
+        """
+        Administers a drug in cycles: onSteps time steps on, then offSteps
+        time steps off, starting at timestep start. The events of a regimen
+        count as added when the regimen is (see addEvent).
+
+        drug: the name of the drug (a string)
+        start: the first time step of the first cycle (a non-negative integer)
+        onSteps, offSteps: the length of the on and off phases (integers)
+        numCycles: the number of cycles (an integer), or None to repeat the
+        cycle until the end of the trial
+        """
+        if start < 0:
+            raise ValueError('Cannot start a regimen before timestep 0: '+str(start))
+        self.regimens.append((drug, start, onSteps, offSteps, numCycles))
+        self.regimenPositions.append(len(self.events))
+
+    def getDrugs(self):
+        """
+        Returns the names of all drugs that appear in this schedule (a list of
+        strings, in order of first appearance).
+        """
+        drugs = []
+        for drug in [event[1] for event in self.events] + [regimen[0] for regimen in self.regimens]:
+            if drug not in drugs:
+                drugs.append(drug)
+        return drugs
+
+    def getEvents(self, numSteps):
+        """
+        Expands the regimens into events and returns every event before
+        numSteps, sorted by time step and then by the order they were added
+        (a list of (timestep, drug, isActive) tuples).
+        """
+        # each event is sorted on (timestep, position), where a regimen sits
+        # just before the first event added after it
+        ordered = [((event[0], position, 0), event) for position, event in enumerate(self.events)]
+        for index, regimen in enumerate(self.regimens):
+            drug, start, onSteps, offSteps, numCycles = regimen
+            position = (self.regimenPositions[index], -1, index)
+            cycle = 0
+            cycleStart = start
+            while cycleStart < numSteps and (numCycles is None or cycle < numCycles):
+                ordered.append(((cycleStart,) + position + (2 * cycle,), (cycleStart, drug, True)))
+                ordered.append(((cycleStart + onSteps,) + position + (2 * cycle + 1,),
+                                (cycleStart + onSteps, drug, False)))
+                cycle += 1
+                cycleStart += onSteps + offSteps
+                if onSteps + offSteps <= 0:
+                    break
+        ordered.sort(key=lambda entry: entry[0])
+        return [event for key, event in ordered if event[0] < numSteps]
+
+    def getActiveDrugs(self, numSteps):
+        """
+        Precomputes the drugs that act at every time step of a trial.
+
+        numSteps: the number of time steps of the trial (an integer)
+
+        returns: a list with one tuple of drug names per time step. Steps
+        with the same drugs share one tuple, so a change of regimen can be
+        spotted with an identity check.
+        """
+        drugs = self.getDrugs()
+        events = self.getEvents(numSteps)
+        active = set()
+        current = ()
+        activeDrugs = []
+        nextEvent = 0
+        for timestep in range(numSteps):
+            while nextEvent < len(events) and events[nextEvent][0] == timestep:
+                eventStep, drug, isActive = events[nextEvent]
+                if isActive:
+                    active.add(drug)
+                else:
+                    active.discard(drug)
+                nextEvent += 1
+            if set(current) != active:
+                current = tuple(drug for drug in drugs if drug in active)
+            activeDrugs.append(current)
+        return activeDrugs
+
+    def toDict(self):
+        """
+        Returns a JSON-serializable description of this schedule, used to
+        identify it in sweep checkpoints and results tables.
+        """
+        return {'events': [list(event) for event in self.events],
+                'regimens': [list(regimen) for regimen in self.regimens],
+                'regimenPositions': list(self.regimenPositions)}
+
+    @classmethod
+    def fromDict(cls, description):
+        """
+        Builds a schedule from the description returned by toDict(). Without
+        'regimenPositions', the regimens count as added after every event.
+
+        returns: a new DosingSchedule
+        """
+        schedule = cls()
+        events = description.get('events', [])
+        regimens = description.get('regimens', [])
+        positions = description.get('regimenPositions', [len(events)] * len(regimens))
+        added = 0
+        for regimen, position in zip(regimens, positions):
+            for timestep, drug, isActive in events[added:position]:
+                schedule.addEvent(timestep, drug, isActive)
+            added = max(added, position)
+            drug, start, onSteps, offSteps, numCycles = regimen
+            schedule.addRegimen(drug, start, onSteps, offSteps, numCycles)
+        for timestep, drug, isActive in events[added:]:
+            schedule.addEvent(timestep, drug, isActive)
+        return schedule
+
+
+def makeDefaultSchedule():
+    """
+    Returns the schedule of the original simulationWithDrug: guttagonol from
+    timestep 150 onwards (a DosingSchedule).
+    """
+    schedule = DosingSchedule()
+    schedule.addDose('guttagonol', 150)
+    return schedule
+
+def withDrugSeries(schedule=None):
+    """
+    Returns the names of the series returned by runTrialWithDrug for a
+    schedule: the total population and the population resistant to every
+    drug of the schedule (a tuple of strings). The default schedule gives
+    SERIES_WITH_DRUG.
+    """
+    if schedule is None:
+        schedule = makeDefaultSchedule()
+    return ('total', 'resistant_'+'_'.join(schedule.getDrugs()))
+
+
+# The names of the series returned by runTrialWithDrug with the default
+# schedule
+SERIES_WITH_DRUG = ('total', 'resistant_guttagonol')
+
+def runTrialWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                     mutProb, engine='object', schedule=None, numSteps=300,
+                     seed=None, checkpointDir=None, checkpointEvery=100,
+                     steadyStateWindow=None):
+    """
+    Runs a single simulationWithDrug trial: instantiates a patient and
+    updates it numSteps times, following a dosing schedule. By default it
+    updates the patient for 150 timesteps, adds guttagonol, and updates it
+    for an additional 150 timesteps.
+
+    schedule: the drugs to administer (a DosingSchedule), or None for
+    makeDefaultSchedule()
+    numSteps: the number of timesteps (an integer)
+    seed: the seed of this trial (a numpy SeedSequence, as returned by
+    makeTrialSeeds), or None for an unseeded trial
+    checkpointDir, checkpointEvery: snapshot every checkpointEvery timesteps
+    to checkpointDir, and resume from the snapshot found there (see
+    runTrialWithoutDrug)
+    steadyStateWindow: once the populations have settled over this many
+    timesteps of the same regimen, fill the timesteps up to the next change
+    of regimen with their means instead of simulating them (see
+    runTrialWithoutDrug), or None to simulate every timestep. An extinct
+    trial fills its remaining timesteps with 0.
+
+    returns: a tuple (virusPop, resistantVirusPop) of lists holding the total
+    virus population and the population resistant to every drug of the
+    schedule after each timestep
+    """
+    _checkSteadyStateWindow(steadyStateWindow)
+    if schedule is None:
+        schedule = makeDefaultSchedule()
+    activeDrugs = schedule.getActiveDrugs(numSteps)
+    scheduleDrugs = schedule.getDrugs()
+    if checkpointDir is not None and os.path.exists(checkpointDir):
+        # the snapshot holds the prescriptions of its last timestep
+        patient, start, stats = loadSnapshot(checkpointDir)
+        virusPop = stats['total']
+        resistantVirusPop = stats['resistant']
+        current = activeDrugs[start - 1] if start else ()
+        # the regimen may have started before the snapshot was taken
+        regimenStart = start
+        while regimenStart > 0 and activeDrugs[regimenStart - 1] is current:
+            regimenStart -= 1
+    else:
+        rng = seedTrial(seed)
+        patient = makeTreatedPatient(engine, numViruses, maxPop, maxBirthProb,
+                                     clearProb, resistances, mutProb, rng)
+        start = 0
+        virusPop = []
+        resistantVirusPop = []
+        current = ()
+        regimenStart = 0
+    timestep = start
+    while timestep < numSteps:
+        if activeDrugs[timestep] is not current:     # the regimen changes
+            current = activeDrugs[timestep]
+            patient.setPrescriptions(current)
+            regimenStart = timestep
+        patient.update()
+        virusPop.append(patient.getTotalPop())
+        resistantVirusPop.append(patient.getResistPop(scheduleDrugs))
+        timestep += 1
+        if virusPop[-1] == 0:
+            # no drug change can bring back a population that died out
+            virusPop.extend([0] * (numSteps - timestep))
+            resistantVirusPop.extend([0] * (numSteps - timestep))
+            break
+        if steadyStateWindow is not None and timestep - regimenStart >= steadyStateWindow:
+            means = _steadyStateMeans((virusPop, resistantVirusPop), steadyStateWindow)
+            if means is not None:
+                # skip to the next change of regimen, which starts from the
+                # state the patient settled in
+                nextChange = timestep
+                while nextChange < numSteps and activeDrugs[nextChange] is current:
+                    nextChange += 1
+                virusPop.extend([means[0]] * (nextChange - timestep))
+                resistantVirusPop.extend([means[1]] * (nextChange - timestep))
+                timestep = nextChange
+                regimenStart = timestep
+        # saved after the checks above, so a resumed trial does not repeat them
+        if checkpointDir is not None and timestep % checkpointEvery == 0:
+            saveSnapshot(checkpointDir, patient, timestep,
+                         {'total': virusPop, 'resistant': resistantVirusPop})
+    return virusPop, resistantVirusPop
 
 
 def simulationWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
-                        mutProb, numTrials):
+                        mutProb, numTrials, engine='object', numWorkers=1,
+                        seed=None, sink=None, plot=True, schedule=None,
+                        numSteps=300, aggregator=None, steadyStateWindow=None):
     """
     For each of numTrials trials, instantiates a patient, runs a simulation for
     150 timesteps, adds guttagonol, and runs the simulation for an additional
     150 timesteps.  At the end plots the average virus population size
     (for both the total virus population and the guttagonol-resistant virus
-    population) as a function of time.
+    population) as a function of time. Pass a schedule to administer other
+    drugs or regimens instead.
 
     numViruses: number of ResistantVirus to create for patient (an integer)
     maxPop: maximum virus population for patient (an integer)
@@ -493,68 +1649,1728 @@ def simulationWithDrug(numViruses, maxPop, maxBirthProb, clearProb, resistances,
     mutProb: mutation probability for each ResistantVirus particle
               (a float between 0-1). 
     numTrials: number of simulation runs to execute (an integer)
-    
+    engine: which population engine to use (a string, one of ENGINES).
+    'object' keeps one ResistantVirus per particle, 'array' uses
+    ArrayTreatedPatient, 'count' uses CountTreatedPatient and 'tau' or
+    'tau:<tolerance>' uses the approximate TauLeapTreatedPatient.
+    numWorkers: number of worker processes to spread the trials over (an
+    integer, see runTrials)
+    seed: master seed for the trials (an integer), or None for unseeded runs
+    sink: where to stream the per-trial results as they arrive (a
+    ResultsSink with the series withDrugSeries(schedule)), or None
+    plot: whether to print and plot the averages (a boolean). Headless runs
+    pass False, which never imports virus_reporting or pylab.
+    schedule: the drugs to administer (a DosingSchedule), or None for
+    guttagonol from timestep 150
+    numSteps: the number of timesteps per trial (an integer)
+    aggregator: a TrialAggregator to collect the per-timestep variance and
+    quantiles in, or None. The plot then shows the 5-95% bands.
+    steadyStateWindow: fast-forward settled regimens (see runTrialWithDrug),
+    or None to simulate every timestep
+
+    returns: a tuple (virusPopAvg, resistantVirusPopAvg) of lists holding the
+    average total virus population and the average population resistant to
+    every drug of the schedule per timestep
     """
 
-    trialCounter = 0
-    virusPop = []
-    resistantVirusPop = []
-    for trial in range(numTrials):
-        trialCounter += 1
-        viruses = []
-        for num in range(numViruses):
-            viruses.append(ResistantVirus(maxBirthProb, clearProb, resistances, mutProb))
-        patient = TreatedPatient(viruses, maxPop)
-
-        timesteps = []
-        counter = 0
-        if trialCounter == 1:               # first trial sets 150 slots for virusPop
-            for timestep in range(150):
-                counter += 1
-                timesteps.append(counter)   # keep track of # of timesteps
-                patient.update()            # update 150 times
-                virusPop.append(patient.getTotalPop())   # add total virus populations to virusPop
-                resistantVirusPop.append(patient.getResistPop(['guttagonol']))
-            patient.addPrescription('guttagonol')   #  add guttagonol drug
-            for timestep in range(150):
-                counter += 1
-                timesteps.append(counter)   # keep track of # of timesteps
-                patient.update()            # update 150 times
-                virusPop.append(patient.getTotalPop())   # add total virus populations to virusPop
-                resistantVirusPop.append(patient.getResistPop(['guttagonol']))
-        
-        else:
-            for timestep in range(150):    # subsequent trials add virusPop to corresponding index
-                counter += 1
-                timesteps.append(counter)
-                patient.update()
-                virusPop[counter-1] += patient.getTotalPop()
-                resistantVirusPop[counter-1] += patient.getResistPop(['guttagonol'])
-            patient.addPrescription('guttagonol')
-            for timestep in range(150):    
-                counter += 1
-                timesteps.append(counter)
-                patient.update()
-                virusPop[counter-1] += patient.getTotalPop()
-                resistantVirusPop[counter-1] += patient.getResistPop(['guttagonol'])
+    _checkSteadyStateWindow(steadyStateWindow)
+    if sink is not None:
+        sink.open(withDrugSeries(schedule))
+    if aggregator is not None and aggregator.seriesNames is None:
+        aggregator.seriesNames = withDrugSeries(schedule)
+    virusPop, resistantVirusPop = runTrials(functools.partial(runTrialWithDrug,
+                                                              steadyStateWindow=steadyStateWindow),
+                                            (numViruses, maxPop, maxBirthProb, clearProb,
+                                             resistances, mutProb, engine, schedule,
+                                             numSteps),
+                                            numTrials, numWorkers, seed, sink,
+                                            aggregator).tolist()
+    if sink is not None:
+        sink.close()
     virusPopAvg = []
     resistantVirusPopAvg = []
-    print('Total Virus Pop:', virusPop)
-    print('Resistant Virus Pop:', resistantVirusPop)
     for item in virusPop:
         virusPopAvg.append(item/numTrials)
     for item in resistantVirusPop:
         resistantVirusPopAvg.append(item/numTrials)
-    print('Avg Total Virus Pop:', virusPopAvg)
-    print('Avg Resistant Virus Pop:', resistantVirusPopAvg)
   
-    pylab.plot(virusPopAvg, label = 'Total')
-    pylab.plot(resistantVirusPopAvg, label = 'ResistantVirus')    
-    pylab.title('ResistantVirus simulation')
-    pylab.xlabel('Time Steps')
-    pylab.ylabel('Average Virus Population')
-    pylab.legend(loc = 'best')
-    pylab.show()
+    if plot:
+        import virus_reporting
+        print('Total Virus Pop:', virusPop)
+        print('Resistant Virus Pop:', resistantVirusPop)
+        print('Avg Total Virus Pop:', virusPopAvg)
+        print('Avg Resistant Virus Pop:', resistantVirusPopAvg)
+        bands = None
+        if aggregator is not None:
+            low, high = aggregator.getQuantile(0.05).tolist(), aggregator.getQuantile(0.95).tolist()
+            bands = {'Total': (low[0], high[0]), 'ResistantVirus': (low[1], high[1])}
+        virus_reporting.plotAverages({'Total': virusPopAvg,
+                                      'ResistantVirus': resistantVirusPopAvg},
+                                     'ResistantVirus simulation', bands)
+    return virusPopAvg, resistantVirusPopAvg
+
+
+class ArrayPatient(object):
+    """
+    Array-backed representation of a simplified patient. Models the same virus
+    population as a Patient, but keeps the per-virus state in NumPy arrays
+    and draws the clearance and birth outcomes of a time step as batched
+    vectors, so a time step costs a handful of array operations instead of
+    one method call per virus particle.
+    """
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, copies the state of the viruses into arrays
+        and saves the maxPop parameter as an attribute.
+
+        viruses: the list representing the virus population (a list of
+        SimpleVirus instances)
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the generator to draw from (a numpy-backed SimulationRNG). A
+        fresh, unseeded one is used if no rng is given.
+        """
+        self.maxBirthProbs = np.array([virus.getMaxBirthProb() for virus in viruses],
+                                      dtype=float)
+        self.clearProbs = np.array([virus.getClearProb() for virus in viruses],
+                                   dtype=float)
+        self.maxPop = maxPop
+        self.rng = SimulationRNG() if rng is None else rng
+
+    @classmethod
+    def fromParams(cls, numViruses, maxPop, maxBirthProb, clearProb, rng=None):
+        """
+        Builds a patient holding numViruses identical viruses without creating
+        a SimpleVirus instance for each of them.
+
+        returns: a new instance of this class
+        """
+        patient = cls([], maxPop, rng)
+        patient.maxBirthProbs = np.full(numViruses, maxBirthProb, dtype=float)
+        patient.clearProbs = np.full(numViruses, clearProb, dtype=float)
+        return patient
+
+    def __str__(self):
+        return 'ArrayPatient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
+
+    def getState(self):
+        """
+        Captures the state of the virus population for a snapshot (see
+        Patient.getState).
+        """
+        return ({'maxPop': self.maxPop},
+                {'maxBirthProbs': self.maxBirthProbs, 'clearProbs': self.clearProbs})
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        """
+        Rebuilds a patient captured by getState(). The arrays are used as
+        they are, so memory-mapped snapshot arrays are only read in as the
+        population is updated.
+        """
+        patient = cls([], meta['maxPop'], rng)
+        patient.maxBirthProbs = arrays['maxBirthProbs']
+        patient.clearProbs = arrays['clearProbs']
+        return patient
+
+    def getMaxPop(self):
+        """
+        Returns the max population.
+        """
+        return self.maxPop
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return len(self.clearProbs)
+
+    def _keep(self, mask):
+        """
+        Keeps only the virus particles selected by mask (a boolean array).
+        """
+        self.maxBirthProbs = self.maxBirthProbs[mask]
+        self.clearProbs = self.clearProbs[mask]
+
+    def _append(self, parents):
+        """
+        Appends one offspring for each index in parents (an integer array).
+        Offspring copy the state of their parent.
+        """
+        self.maxBirthProbs = np.concatenate((self.maxBirthProbs, self.maxBirthProbs[parents]))
+        self.clearProbs = np.concatenate((self.clearProbs, self.clearProbs[parents]))
+
+    def _birthProbs(self, popDensity):
+        """
+        Returns the probability that each virus particle reproduces at the
+        given population density (a float array).
+        """
+        return self.maxBirthProbs * (1 - popDensity)
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, following the same rules as Patient.update():
+
+        - Clear each virus particle with its clearProb.
+
+        - Compute the population density of the survivors.
+
+        - Each survivor reproduces with probability
+          maxBirthProb * (1 - popDensity).
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        self._keep(self.rng.random(self.getTotalPop()) >= self.clearProbs)
+        popDensity = self.getTotalPop() / self.getMaxPop()
+        births = self.rng.random(self.getTotalPop()) < self._birthProbs(popDensity)
+        self._append(np.flatnonzero(births))
+        return self.getTotalPop()
+
+
+class ArrayTreatedPatient(PrescriptionsMixin, ArrayPatient):
+    """
+    Array-backed representation of a TreatedPatient. The resistance profile
+    of every virus particle is kept as a DRUGS bit mask in a uint64 array, so
+    resistance checks are a single mask AND over the whole population, and
+    mutation outcomes are drawn for all offspring at once.
+    """
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, copies the state of the viruses into arrays
+        and initializes the list of drugs being administered (which should
+        initially include no drugs).
+
+        viruses: The list representing the virus population (a list of
+        ResistantVirus instances)
+
+        maxPop: The  maximum virus population for this patient (an integer)
+
+        rng: the generator to draw from (a numpy-backed SimulationRNG)
+        """
+        ArrayPatient.__init__(self, viruses, maxPop, rng)
+        # traitBits marks which drugs a virus carries a resistance trait for;
+        # only those traits can mutate, like the keys of virus.resistances
+        self.traitBits = np.array([virus.traitBits for virus in viruses], dtype=np.uint64)
+        self.resistBits = np.array([virus.resistBits for virus in viruses], dtype=np.uint64)
+        self.mutProbs = np.array([virus.mutProb for virus in viruses], dtype=float)
+        self.drugs = []
+        self.activeMask = 0
+
+    @classmethod
+    def fromParams(cls, numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                   mutProb, rng=None):
+        """
+        Builds a patient holding numViruses identical viruses without creating
+        a ResistantVirus instance for each of them.
+
+        returns: a new instance of this class
+        """
+        patient = cls([], maxPop, rng)
+        patient.maxBirthProbs = np.full(numViruses, maxBirthProb, dtype=float)
+        patient.clearProbs = np.full(numViruses, clearProb, dtype=float)
+        traits, resistant = DRUGS.encode(resistances)
+        patient.traitBits = np.full(numViruses, traits, dtype=np.uint64)
+        patient.resistBits = np.full(numViruses, resistant, dtype=np.uint64)
+        patient.mutProbs = np.full(numViruses, mutProb, dtype=float)
+        return patient
+
+    def __str__(self):
+        return 'ArrayTreatedPatient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
+
+    def getState(self):
+        meta, arrays = ArrayPatient.getState(self)
+        meta['drugs'] = list(self.drugs)
+        arrays.update(traitBits=self.traitBits, resistBits=self.resistBits,
+                      mutProbs=self.mutProbs)
+        return meta, arrays
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        patient = super().fromState(meta, arrays, rng)
+        patient.traitBits = arrays['traitBits']
+        patient.resistBits = arrays['resistBits']
+        patient.mutProbs = arrays['mutProbs']
+        _restorePrescriptions(patient, meta)
+        return patient
+
+    def _resistantToAll(self, mask):
+        """
+        Returns a boolean array marking the virus particles that are resistant
+        to every drug in mask (a DRUGS mask).
+        """
+        mask = np.uint64(mask)
+        return self.resistBits & mask == mask
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        mask = DRUGS.findMask(drugResist)
+        if mask is None:    # no virus is resistant to an unknown drug
+            return 0
+        return int(np.count_nonzero(self._resistantToAll(mask)))
+
+    def _keep(self, mask):
+        ArrayPatient._keep(self, mask)
+        self.traitBits = self.traitBits[mask]
+        self.resistBits = self.resistBits[mask]
+        self.mutProbs = self.mutProbs[mask]
+
+    def _append(self, parents):
+        ArrayPatient._append(self, parents)
+        traits = self.traitBits[parents]
+        childBits = self.resistBits[parents]
+        mutProbs = self.mutProbs[parents]
+        # every resistance trait of an offspring flips with its mutProb
+        allTraits = int(np.bitwise_or.reduce(traits)) if len(traits) else 0
+        for bit in DRUGS.getTraitBits(allTraits):
+            bit = np.uint64(bit)
+            flips = (traits & bit != 0) & (self.rng.random(len(parents)) < mutProbs)
+            childBits ^= np.where(flips, bit, np.uint64(0))
+        self.traitBits = np.concatenate((self.traitBits, traits))
+        self.resistBits = np.concatenate((self.resistBits, childBits))
+        self.mutProbs = np.concatenate((self.mutProbs, self.mutProbs[parents]))
+
+    def _birthProbs(self, popDensity):
+        # viruses that are not resistant to every active drug do not reproduce
+        return np.where(self._resistantToAll(self.activeMask),
+                        ArrayPatient._birthProbs(self, popDensity), 0.0)
+
+
+class CountPatient(object):
+    """
+    Genotype-aggregated representation of a simplified patient. Virus
+    particles with the same parameters are interchangeable, so instead of one
+    entry per particle this patient stores one count per genotype and draws
+    the clearances and births of each genotype with binomial draws. A time
+    step costs O(number of distinct genotypes), which makes populations in the
+    billions feasible.
+    """
+    # the (array attribute, dtype) of every parameter that makes up a genotype
+    FIELDS = (('maxBirthProbs', float), ('clearProbs', float))
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, groups the viruses by genotype and saves the
+        maxPop parameter as an attribute.
+
+        viruses: the list representing the virus population (a list of
+        SimpleVirus instances)
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the generator to draw from (a numpy-backed SimulationRNG). A
+        fresh, unseeded one is used if no rng is given.
+        """
+        self.maxPop = maxPop
+        self.rng = SimulationRNG() if rng is None else rng
+        genotypeCounts = {}
+        for virus in viruses:
+            key = self._genotypeOf(virus)
+            genotypeCounts[key] = genotypeCounts.get(key, 0) + 1
+        self._setGenotypes(genotypeCounts)
+
+    @classmethod
+    def fromParams(cls, numViruses, maxPop, maxBirthProb, clearProb, rng=None):
+        """
+        Builds a patient holding numViruses identical viruses without creating
+        a SimpleVirus instance for each of them.
+
+        returns: a new instance of this class
+        """
+        patient = cls([], maxPop, rng)
+        patient._setGenotypes({(maxBirthProb, clearProb): numViruses})
+        return patient
+
+    def __str__(self):
+        return 'CountPatient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
+
+    def _genotypeOf(self, virus):
+        """
+        Returns the genotype key (a tuple matching FIELDS) of a virus instance.
+        """
+        return (virus.getMaxBirthProb(), virus.getClearProb())
+
+    def _setGenotypes(self, genotypeCounts):
+        """
+        Replaces the genotype table with the genotypes in genotypeCounts (a
+        dictionary mapping genotype keys to counts). Genotypes with a count of
+        zero are dropped.
+        """
+        self._setTable({key: count for key, count in genotypeCounts.items() if count > 0})
+
+    def _setTable(self, genotypeCounts):
+        """
+        Replaces the genotype table with every genotype in genotypeCounts, in
+        insertion order, including genotypes with a count of zero.
+        """
+        self.keys = list(genotypeCounts)
+        self.index = {key: row for row, key in enumerate(self.keys)}
+        self.counts = np.array([genotypeCounts[key] for key in self.keys], dtype=np.int64)
+        for column, (name, dtype) in enumerate(self.FIELDS):
+            setattr(self, name, np.array([key[column] for key in self.keys], dtype=dtype))
+
+    def _addGenotypes(self, keys, counts):
+        """
+        Adds counts[i] viruses of genotype keys[i] to the population, creating
+        rows at the end of the table for genotypes that are not in it yet.
+        Existing rows keep their position, even if their count is zero.
+        """
+        genotypeCounts = dict(zip(self.keys, self.counts.tolist()))
+        for key, count in zip(keys, counts):
+            genotypeCounts[key] = genotypeCounts.get(key, 0) + count
+        self._setTable(genotypeCounts)
+
+    def getGenotypes(self):
+        """
+        Returns a dictionary mapping each genotype key (a tuple of the FIELDS
+        values) to the number of viruses with that genotype.
+        """
+        return dict(zip(self.keys, self.counts.tolist()))
+
+    def getState(self):
+        """
+        Captures the genotype table for a snapshot (see Patient.getState):
+        one array per FIELDS entry and the counts, row by row.
+        """
+        arrays = {name: getattr(self, name) for name, dtype in self.FIELDS}
+        arrays['counts'] = self.counts
+        return {'maxPop': self.maxPop}, arrays
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        """
+        Rebuilds a patient captured by getState(), with the genotype rows in
+        the same order.
+        """
+        patient = cls([], meta['maxPop'], rng)
+        keys = zip(*[arrays[name].tolist() for name, dtype in cls.FIELDS])
+        patient._setTable(dict(zip(keys, arrays['counts'].tolist())))
+        return patient
+
+    def getMaxPop(self):
+        """
+        Returns the max population.
+        """
+        return self.maxPop
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return int(self.counts.sum())
+
+    def _birthProbs(self, popDensity):
+        """
+        Returns the probability that a virus of each genotype reproduces at
+        the given population density (a float array).
+        """
+        return np.clip(self.maxBirthProbs * (1 - popDensity), 0.0, 1.0)
+
+    def _addOffspring(self, births):
+        """
+        Adds births[i] offspring of genotype i to the population.
+        """
+        self.counts += births
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, following the same rules as Patient.update(), with the
+        clearances and births of each genotype drawn as binomials.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        self.counts -= self.rng.binomial(self.counts, self.clearProbs)
+        popDensity = self.getTotalPop() / self.getMaxPop()
+        self._addOffspring(self.rng.binomial(self.counts, self._birthProbs(popDensity)))
+        if not self.counts.all():
+            self._setGenotypes(self.getGenotypes())
+        return self.getTotalPop()
+
+
+class CountTreatedPatient(PrescriptionsMixin, CountPatient):
+    """
+    Genotype-aggregated representation of a TreatedPatient. A genotype also
+    includes the mutation probability and the DRUGS resistance masks, and
+    mutations move offspring counts between genotypes.
+    """
+    FIELDS = CountPatient.FIELDS + (('mutProbs', float), ('traitBits', np.uint64),
+                                    ('resistBits', np.uint64))
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, groups the viruses by genotype and
+        initializes the list of drugs being administered (which should
+        initially include no drugs).
+
+        viruses: The list representing the virus population (a list of
+        ResistantVirus instances)
+
+        maxPop: The  maximum virus population for this patient (an integer)
+
+        rng: the generator to draw from (a numpy-backed SimulationRNG)
+        """
+        CountPatient.__init__(self, viruses, maxPop, rng)
+        self.drugs = []
+        self.activeMask = 0
+
+    @classmethod
+    def fromParams(cls, numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                   mutProb, rng=None):
+        """
+        Builds a patient holding numViruses identical viruses without creating
+        a ResistantVirus instance for each of them.
+
+        returns: a new instance of this class
+        """
+        patient = cls([], maxPop, rng)
+        traits, resistant = DRUGS.encode(resistances)
+        patient._setGenotypes({(maxBirthProb, clearProb, mutProb, traits, resistant): numViruses})
+        return patient
+
+    def __str__(self):
+        return 'CountTreatedPatient with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
+
+    def getState(self):
+        meta, arrays = CountPatient.getState(self)
+        meta['drugs'] = list(self.drugs)
+        return meta, arrays
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        patient = super().fromState(meta, arrays, rng)
+        _restorePrescriptions(patient, meta)
+        return patient
+
+    def _genotypeOf(self, virus):
+        return (virus.getMaxBirthProb(), virus.getClearProb(), virus.mutProb,
+                virus.traitBits, virus.resistBits)
+
+    def _resistantToAll(self, mask):
+        """
+        Returns a boolean array marking the genotypes that are resistant to
+        every drug in mask (a DRUGS mask).
+        """
+        mask = np.uint64(mask)
+        return self.resistBits & mask == mask
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        mask = DRUGS.findMask(drugResist)
+        if mask is None:    # no virus is resistant to an unknown drug
+            return 0
+        return int(self.counts[self._resistantToAll(mask)].sum())
+
+    def _birthProbs(self, popDensity):
+        # genotypes that are not resistant to every active drug do not reproduce
+        return np.where(self._resistantToAll(self.activeMask),
+                        CountPatient._birthProbs(self, popDensity), 0.0)
+
+    def _addOffspring(self, births):
+        # Offspring start as groups of (parent row, profile, count). For each
+        # resistance trait a binomial draw splits off the offspring in which
+        # that trait flips, which together amounts to a multinomial draw over
+        # all the profiles the offspring can mutate to.
+        rows = np.flatnonzero(births)
+        numbers = births[rows]
+        childBits = self.resistBits[rows]
+        allTraits = int(np.bitwise_or.reduce(self.traitBits[rows])) if len(rows) else 0
+        for bit in DRUGS.getTraitBits(allTraits):
+            bit = np.uint64(bit)
+            mutProbs = np.where(self.traitBits[rows] & bit != 0, self.mutProbs[rows], 0.0)
+            flips = self.rng.binomial(numbers, mutProbs)
+            if not flips.any():
+                continue
+            numbers = numbers - flips
+            flipped = flips > 0
+            rows = np.concatenate((rows, rows[flipped]))
+            childBits = np.concatenate((childBits, childBits[flipped] ^ bit))
+            numbers = np.concatenate((numbers, flips[flipped]))
+        mutated = childBits != self.resistBits[rows]
+        np.add.at(self.counts, rows[~mutated], numbers[~mutated])
+        keys = [self.keys[row][:-1] + (bits,)
+                for row, bits in zip(rows[mutated].tolist(), childBits[mutated].tolist())]
+        if keys:
+            self._addGenotypes(keys, numbers[mutated].tolist())
+
+
+# The default relative error tolerance of the tau-leaping engine
+TAU_TOLERANCE = 0.03
+
+class TauLeapPatient(CountPatient):
+    """
+    Approximate, tau-leaping version of CountPatient. Whenever the expected
+    change of the population over several time steps is small, this patient
+    leaps over those steps at once: the clearances and births of each
+    genotype during the leap are drawn as single Poisson variates, with the
+    population density held at its value at the start of the leap. The
+    counts of the steps inside a leap are interpolated between the start
+    and the end of the leap, so update() still advances a single time step.
+
+    The leap length tau is the largest number of steps for which the
+    expected change and the standard deviation of the total population
+    both stay within tolerance times the population (the tau selection of
+    Cao, Gillespie and Petzold). While the population changes quickly,
+    tau falls below 2 and the patient takes exact binomial steps instead.
+    """
+    # the longest leap, which bounds how stale the interpolated steps can be
+    MAX_LEAP = 50
+
+    def __init__(self, viruses, maxPop, rng=None, tolerance=TAU_TOLERANCE):
+        """
+        Initialization function, see CountPatient.
+
+        tolerance: the relative error tolerance (a float). Smaller values
+        give shorter leaps and results closer to the exact engines.
+        """
+        super().__init__(viruses, maxPop, rng)
+        self.tolerance = tolerance
+        self.leapLength = 0
+        self.leapStep = 0
+
+    def __str__(self):
+        return type(self).__name__+' with'+str(self.getTotalPop())+' viruses and maxPop:'+str(self.maxPop)
+
+    def getState(self):
+        """
+        Captures the genotype table and the current leap for a snapshot (see
+        CountPatient.getState).
+        """
+        meta, arrays = super().getState()
+        meta.update(tolerance=self.tolerance, leapLength=self.leapLength,
+                    leapStep=self.leapStep)
+        if self.leapLength:
+            arrays.update(leapStart=self.leapStart, leapEnd=self.leapEnd)
+        return meta, arrays
+
+    @classmethod
+    def fromState(cls, meta, arrays, rng):
+        patient = super().fromState(meta, arrays, rng)
+        patient.tolerance = meta['tolerance']
+        patient.leapLength = meta['leapLength']
+        patient.leapStep = meta['leapStep']
+        if patient.leapLength:
+            patient.leapStart = np.array(arrays['leapStart'])
+            patient.leapEnd = np.array(arrays['leapEnd'])
+        return patient
+
+    def _chooseLeap(self):
+        """
+        Returns the number of steps (an integer) the population can leap over
+        within the error tolerance.
+        """
+        counts = self.counts
+        survival = 1 - self.clearProbs
+        birthProbs = self._birthProbs((counts * survival).sum() / self.getMaxPop())
+        mean = (counts * (survival * (1 + birthProbs) - 1)).sum()
+        variance = (counts * ((1 + birthProbs) ** 2 * self.clearProbs * survival +
+                              survival * birthProbs * (1 - birthProbs))).sum()
+        bound = max(self.tolerance * counts.sum(), 1.0)
+        leap = self.MAX_LEAP
+        if mean != 0:
+            leap = min(leap, bound / abs(mean))
+        if variance > 0:
+            leap = min(leap, bound ** 2 / variance)
+        return int(leap)
+
+    def _startLeap(self, leapLength):
+        """
+        Draws the outcome of a leap over leapLength steps and records the
+        counts at its start and end for interpolation.
+        """
+        counts = self.counts
+        survival = 1 - self.clearProbs
+        birthProbs = self._birthProbs((counts * survival).sum() / self.getMaxPop())
+        clearances = self.rng.poisson(leapLength * counts * self.clearProbs)
+        births = self.rng.poisson(leapLength * counts * survival * birthProbs)
+        numRows = len(counts)
+        self.leapStart = counts.astype(float)
+        self.counts = counts - clearances
+        self._addOffspring(births)    # mutants are appended as new rows
+        self.leapStart = np.concatenate((self.leapStart, np.zeros(len(self.counts) - numRows)))
+        self.leapEnd = np.maximum(self.counts, 0).astype(float)
+        self.counts = self.leapStart.astype(np.int64)
+        self.leapLength = leapLength
+        self.leapStep = 0
+
+    def _endLeap(self):
+        """
+        Ends the current leap at the current step, keeping the interpolated
+        counts as the state of the population.
+        """
+        self.leapLength = 0
+        self.leapStep = 0
+        if not self.counts.all():
+            self._setGenotypes(self.getGenotypes())
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, either by moving one step further through the current
+        leap, by starting a new leap, or by taking an exact CountPatient step
+        when no leap of at least 2 steps fits the tolerance.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        if self.leapStep == self.leapLength:
+            leapLength = self._chooseLeap()
+            if leapLength < 2:
+                return CountPatient.update(self)
+            self._startLeap(leapLength)
+        self.leapStep += 1
+        fraction = self.leapStep / self.leapLength
+        self.counts = np.rint(self.leapStart + (self.leapEnd - self.leapStart) * fraction).astype(np.int64)
+        if self.leapStep == self.leapLength:
+            self._endLeap()
+        return self.getTotalPop()
+
+
+class TauLeapTreatedPatient(TauLeapPatient, CountTreatedPatient):
+    """
+    Approximate, tau-leaping version of CountTreatedPatient. A change of
+    prescriptions ends the current leap, since it changes which genotypes
+    can reproduce.
+    """
+
+    def _prescriptionsChanged(self):
+        self._endLeap()
+        CountTreatedPatient._prescriptionsChanged(self)
+
+
+def validateTauLeap(numViruses, maxPop, maxBirthProb, clearProb, resistances,
+                    mutProb, numTrials, tolerance=TAU_TOLERANCE,
+                    referenceEngine='array', seed=None):
+    """
+    Compares the tau-leaping engine with an exact engine on a
+    simulationWithDrug case small enough for the exact engine to run.
+
+    tolerance: the error tolerance of the tau-leaping engine (a float)
+    referenceEngine: the exact engine to compare against (a string, one of
+    ENGINES)
+    Other parameters are those of simulationWithDrug.
+
+    returns: a dictionary holding the summaries of both engines under
+    'reference' and 'tauLeap' (see summarizeTrials), plus for every series
+    the largest standardized difference of the means over all timesteps
+    under 'meanError' and the largest relative difference of the variances
+    under 'varianceError' (dictionaries mapping series names to floats). A
+    mean error well above 3 points to a real bias.
+    """
+    args = (numViruses, maxPop, maxBirthProb, clearProb, resistances, mutProb)
+    summaries = {}
+    for name, engine in (('reference', referenceEngine), ('tauLeap', 'tau:'+str(tolerance))):
+        trials = [runTrialWithDrug(*args, engine=engine, seed=trialSeed)
+                  for trialSeed in makeTrialSeeds(seed, numTrials)]
+        summaries[name] = summarizeTrials(trials, SERIES_WITH_DRUG, ())
+    reference = summaries['reference']
+    tauLeap = summaries['tauLeap']
+    summaries['meanError'] = {}
+    summaries['varianceError'] = {}
+    for series in SERIES_WITH_DRUG:
+        referenceMean = np.array(reference['mean'][series])
+        referenceVariance = np.array(reference['variance'][series])
+        tauMean = np.array(tauLeap['mean'][series])
+        tauVariance = np.array(tauLeap['variance'][series])
+        standardError = np.sqrt((referenceVariance + tauVariance) / numTrials)
+        summaries['meanError'][series] = float(np.max(np.abs(tauMean - referenceMean) /
+                                                      np.maximum(standardError, 1e-9)))
+        summaries['varianceError'][series] = float(np.max(np.abs(tauVariance - referenceVariance) /
+                                                          np.maximum(referenceVariance, 1.0)))
+    return summaries
+
+
+class TreatedCohort(PrescriptionsMixin):
+    """
+    A cohort of treated patients advanced together. Every patient has its
+    own maxPop and starting load, but all viruses share maxBirthProb,
+    clearProb and mutProb, so the cohort is stored as one matrix of virus
+    counts with a row per patient and a column per resistance profile.
+    update() advances every patient with a handful of binomial draws over
+    the whole matrix, spreading the interpreter overhead over the cohort.
+    """
+    # each resistance trait doubles the number of profile columns
+    MAX_TRAITS = 12
+
+    def __init__(self, numViruses, maxPops, maxBirthProb, clearProb, resistances,
+                 mutProb, rng=None):
+        """
+        Initializes the cohort with no drugs prescribed.
+
+        numViruses: the starting number of viruses of each patient (a list or
+        array of integers, or one integer for every patient)
+        maxPops: the maximum virus population of each patient (a list or
+        array of integers)
+        maxBirthProb: Maximum reproduction probability (a float between 0-1)
+        clearProb: Maximum clearance probability (a float between 0-1)
+        resistances: the resistances of the starting viruses (a dictionary of
+        drug names mapping to True or False, as for ResistantVirus)
+        mutProb: Mutation probability (a float between 0-1)
+        rng: the generator to draw from (a numpy-backed SimulationRNG)
+        """
+        self.maxPops = np.array(maxPops, dtype=np.int64)
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.mutProb = mutProb
+        self.rng = SimulationRNG() if rng is None else rng
+        traits, resistant = DRUGS.encode(resistances)
+        self.traitBits = list(DRUGS.getTraitBits(traits))
+        if len(self.traitBits) > self.MAX_TRAITS:
+            raise ValueError('A cohort supports at most '+str(self.MAX_TRAITS)+' resistance traits')
+        # column c holds the profile with traitBits[j] set for every bit j of c
+        self.profiles = np.zeros(2 ** len(self.traitBits), dtype=np.uint64)
+        for j, bit in enumerate(self.traitBits):
+            self.profiles[np.arange(len(self.profiles)) >> j & 1 == 1] |= np.uint64(bit)
+        self.counts = np.zeros((len(self.maxPops), len(self.profiles)), dtype=np.int64)
+        self.counts[:, int(np.flatnonzero(self.profiles == resistant)[0])] = numViruses
+        self.drugs = []
+        self.activeMask = 0
+
+    def __str__(self):
+        return 'TreatedCohort with '+str(len(self.maxPops))+' patients and '+str(self.getTotalPop())+' viruses'
+
+    def getNumPatients(self):
+        """
+        Returns the number of patients in the cohort.
+        """
+        return len(self.maxPops)
+
+    def getTotalPops(self):
+        """
+        Returns the total virus population of each patient (an integer array).
+        """
+        return self.counts.sum(axis=1)
+
+    def getTotalPop(self):
+        """
+        Returns the total virus population of the whole cohort (an integer).
+        """
+        return int(self.counts.sum())
+
+    def _resistantToAll(self, mask):
+        """
+        Returns a boolean array marking the profile columns that are resistant
+        to every drug in mask (a DRUGS mask).
+        """
+        mask = np.uint64(mask)
+        return self.profiles & mask == mask
+
+    def getResistPops(self, drugResist):
+        """
+        Returns the population of each patient (an integer array) resistant to
+        every drug in drugResist (a list of strings).
+        """
+        mask = DRUGS.findMask(drugResist)
+        if mask is None:    # no virus is resistant to an unknown drug
+            return np.zeros(len(self.maxPops), dtype=np.int64)
+        return self.counts[:, self._resistantToAll(mask)].sum(axis=1)
+
+    def update(self):
+        """
+        Update every patient of the cohort for a single time step, following
+        the rules of TreatedPatient.update(): binomial clearances, then births
+        at each patient's population density for the profiles resistant to
+        every prescribed drug, then a binomial split per resistance trait
+        that moves mutated offspring to the profile with that trait flipped.
+
+        returns: The total virus population of each patient at the end of the
+        update (an integer array)
+        """
+        self.counts -= self.rng.binomial(self.counts, self.clearProb)
+        popDensities = self.counts.sum(axis=1) / self.maxPops
+        birthProbs = np.clip(self.maxBirthProb * (1 - popDensities), 0.0, 1.0)
+        birthProbs = birthProbs[:, None] * self._resistantToAll(self.activeMask)[None, :]
+        births = self.rng.binomial(self.counts, birthProbs)
+        columns = np.arange(len(self.profiles))
+        for j in range(len(self.traitBits)):
+            flips = self.rng.binomial(births, self.mutProb)
+            # column c ^ (1 << j) holds the profile with trait j flipped
+            births += flips[:, columns ^ (1 << j)] - flips
+        self.counts += births
+        return self.getTotalPops()
+
+
+def simulateCohort(numViruses, maxPops, maxBirthProb, clearProb, resistances,
+                   mutProb, schedule=None, numSteps=300, seed=None):
+    """
+    Simulates a TreatedCohort for numSteps timesteps under a dosing schedule.
+
+    numViruses, maxPops: the starting load and maximum population of each
+    patient (see TreatedCohort)
+    schedule: the drugs to administer (a DosingSchedule), or None for
+    makeDefaultSchedule()
+    seed: the seed (an integer or numpy SeedSequence), or None for an
+    unseeded run
+    Other parameters are those of simulationWithDrug.
+
+    returns: a dictionary of trajectories. 'total' and 'resistant' hold the
+    total population and the population resistant to every drug of the
+    schedule per patient and timestep (integer arrays with one row per
+    patient); 'cohortTotal' and 'cohortResistant' hold their averages over
+    the patients per timestep (float arrays).
+    """
+    if schedule is None:
+        schedule = makeDefaultSchedule()
+    cohort = TreatedCohort(numViruses, maxPops, maxBirthProb, clearProb, resistances,
+                           mutProb, SimulationRNG(seed))
+    activeDrugs = schedule.getActiveDrugs(numSteps)
+    scheduleDrugs = schedule.getDrugs()
+    total = np.zeros((cohort.getNumPatients(), numSteps), dtype=np.int64)
+    resistant = np.zeros((cohort.getNumPatients(), numSteps), dtype=np.int64)
+    current = ()
+    for timestep in range(numSteps):
+        if activeDrugs[timestep] is not current:
+            current = activeDrugs[timestep]
+            cohort.setPrescriptions(current)
+        total[:, timestep] = cohort.update()
+        resistant[:, timestep] = cohort.getResistPops(scheduleDrugs)
+    return {'total': total, 'resistant': resistant,
+            'cohortTotal': total.mean(axis=0), 'cohortResistant': resistant.mean(axis=0)}
+
+
+# 'tau' also accepts a tolerance, e.g. 'tau:0.01' (see TauLeapPatient)
+ENGINES = ('object', 'array', 'count', 'tau')
+
+def _tauTolerance(engine):
+    """
+    Returns the tolerance given in a 'tau' or 'tau:<tolerance>' engine name (a
+    float), or None if engine names another engine.
+    """
+    name, separator, tolerance = str(engine).partition(':')
+    if name != 'tau':
+        return None
+    return float(tolerance) if separator else TAU_TOLERANCE
+
+def makePatient(engine, numViruses, maxPop, maxBirthProb, clearProb, rng=None):
+    """
+    Creates a patient holding numViruses SimpleVirus particles, using the
+    population engine named by engine (a string, one of ENGINES).
+
+    rng: the generator the patient draws from (a SimulationRNG). The object
+    engine falls back to GLOBAL_RNG, the others to a fresh generator.
+
+    returns: a Patient, an ArrayPatient, a CountPatient or a TauLeapPatient
+    """
+    if engine == 'object':
+        viruses = []
+        for num in range(numViruses):
+            viruses.append(SimpleVirus(maxBirthProb, clearProb))
+        return Patient(viruses, maxPop, rng)
+    if engine == 'array':
+        return ArrayPatient.fromParams(numViruses, maxPop, maxBirthProb, clearProb, rng)
+    if engine == 'count':
+        return CountPatient.fromParams(numViruses, maxPop, maxBirthProb, clearProb, rng)
+    if _tauTolerance(engine) is not None:
+        patient = TauLeapPatient.fromParams(numViruses, maxPop, maxBirthProb, clearProb, rng)
+        patient.tolerance = _tauTolerance(engine)
+        return patient
+    raise ValueError('Unknown engine: '+str(engine))
+
+def makeTreatedPatient(engine, numViruses, maxPop, maxBirthProb, clearProb,
+                       resistances, mutProb, rng=None):
+    """
+    Creates a treated patient holding numViruses ResistantVirus particles,
+    using the population engine named by engine (a string, one of ENGINES).
+
+    rng: the generator the patient draws from (a SimulationRNG). The object
+    engine falls back to GLOBAL_RNG, the others to a fresh generator.
+
+    returns: a TreatedPatient, an ArrayTreatedPatient, a CountTreatedPatient or
+    a TauLeapTreatedPatient
+    """
+    if engine == 'object':
+        viruses = []
+        for num in range(numViruses):
+            viruses.append(ResistantVirus(maxBirthProb, clearProb, resistances, mutProb))
+        return TreatedPatient(viruses, maxPop, rng)
+    if engine == 'array':
+        return ArrayTreatedPatient.fromParams(numViruses, maxPop, maxBirthProb,
+                                              clearProb, resistances, mutProb, rng)
+    if engine == 'count':
+        return CountTreatedPatient.fromParams(numViruses, maxPop, maxBirthProb,
+                                              clearProb, resistances, mutProb, rng)
+    if _tauTolerance(engine) is not None:
+        patient = TauLeapTreatedPatient.fromParams(numViruses, maxPop, maxBirthProb,
+                                                   clearProb, resistances, mutProb, rng)
+        patient.tolerance = _tauTolerance(engine)
+        return patient
+    raise ValueError('Unknown engine: '+str(engine))
+
+
+# The patient classes a snapshot can hold, by name
+SNAPSHOT_CLASSES = {cls.__name__: cls for cls in
+                    (Patient, TreatedPatient, ArrayPatient, ArrayTreatedPatient,
+                     CountPatient, CountTreatedPatient, TauLeapPatient, TauLeapTreatedPatient)}
+SNAPSHOT_FORMAT = 1
+
+def saveSnapshot(directory, patient, timestep=0, stats=None):
+    """
+    Writes a snapshot of a patient: a directory holding a meta.json file and
+    one .npy file per array (the population arrays or genotype counts, the
+    unused uniforms of the generator's buffer and each statistic). The
+    snapshot also records the prescriptions, the generator state and the
+    DRUGS bit assignment, so that loadSnapshot() can continue the run with
+    exactly the same draws. An existing snapshot in directory is only
+    replaced once the new one is complete.
+
+    directory: the snapshot directory (a string)
+    patient: the patient (an instance of one of SNAPSHOT_CLASSES)
+    timestep: the number of timesteps the patient has been updated for (an
+    integer)
+    stats: the statistics accumulated so far, e.g. the series of a trial (a
+    dictionary mapping names to lists or arrays of numbers), or None
+    """
+    if type(patient).__name__ not in SNAPSHOT_CLASSES:
+        raise ValueError('Cannot snapshot a '+type(patient).__name__)
+    stats = {} if stats is None else stats
+    patientMeta, arrays = patient.getState()
+    rngMeta, buffer = patient.rng.getState()
+    meta = {'format': SNAPSHOT_FORMAT, 'class': type(patient).__name__,
+            'timestep': timestep, 'drugNames': list(DRUGS.names),
+            'patient': patientMeta, 'arrays': sorted(arrays),
+            'rng': rngMeta, 'stats': sorted(stats)}
+    temporaryDirectory = directory.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    os.makedirs(temporaryDirectory)
+    for name, values in arrays.items():
+        np.save(os.path.join(temporaryDirectory, 'patient.'+name+'.npy'), values)
+    np.save(os.path.join(temporaryDirectory, 'rng.buffer.npy'), buffer)
+    for name, values in stats.items():
+        np.save(os.path.join(temporaryDirectory, 'stats.'+name+'.npy'), np.asarray(values))
+    with open(os.path.join(temporaryDirectory, 'meta.json'), 'w') as metaFile:
+        json.dump(meta, metaFile)
+    oldDirectory = directory.rstrip(os.sep) + '.old'
+    if os.path.exists(directory):
+        shutil.rmtree(oldDirectory, ignore_errors=True)
+        os.rename(directory, oldDirectory)
+    os.rename(temporaryDirectory, directory)
+    shutil.rmtree(oldDirectory, ignore_errors=True)
+
+def loadSnapshot(directory, mmapMode='c'):
+    """
+    Reads a snapshot written by saveSnapshot(). The arrays are memory-mapped,
+    so a large population is paged in as it is used rather than read up
+    front. The drugs of the snapshot are registered in their saved order,
+    so in a fresh process every mask keeps its bits. If this process has
+    already given those drugs other bits, the masks are translated; since
+    mutations draw their random numbers in order of drug name rather than
+    bit, the run still continues bit-identically.
+
+    directory: the snapshot directory (a string)
+    mmapMode: the mmap_mode for numpy.load (a string, or None to read the
+    arrays into memory). The default 'c' (copy-on-write) lets the patient
+    change its arrays without touching the files.
+
+    returns: a tuple (patient, timestep, stats), with stats a dictionary
+    mapping names to lists
+    """
+    with open(os.path.join(directory, 'meta.json')) as metaFile:
+        meta = json.load(metaFile)
+    if meta['format'] != SNAPSHOT_FORMAT:
+        raise ValueError('Unsupported snapshot format: '+str(meta['format']))
+
+    def load(name):
+        return np.load(os.path.join(directory, name+'.npy'), mmap_mode=mmapMode)
+
+    arrays = {name: load('patient.'+name) for name in meta['arrays']}
+    for name in ('traitBits', 'resistBits'):
+        if name in arrays:
+            arrays[name] = DRUGS.remap(arrays[name], meta['drugNames'])
+    rng = SimulationRNG.fromState(meta['rng'], load('rng.buffer'))
+    patient = SNAPSHOT_CLASSES[meta['class']].fromState(meta['patient'], arrays, rng)
+    stats = {name: load('stats.'+name).tolist() for name in meta['stats']}
+    return patient, meta['timestep'], stats
+
+
+class QuantileSketch(object):
+    """
+    A mergeable streaming quantile sketch in the style of DDSketch, kept for
+    every element of an array at once (e.g. every series and timestep of a
+    trial). Values are counted in logarithmically sized buckets, so every
+    quantile estimate is within relativeAccuracy of a value that was added,
+    and the memory grows with the log of the range of the values rather
+    than with the number of values. Values must not be negative; zeros have
+    a bucket of their own.
+    """
+
+    def __init__(self, shape, relativeAccuracy=0.01):
+        """
+        shape: the shape of the arrays added to the sketch (a tuple)
+        relativeAccuracy: the relative error bound of the estimates (a float
+        between 0-1)
+        """
+        self.shape = tuple(shape)
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = np.log(self.gamma)
+        self.count = 0
+        self.zeros = np.zeros(self.shape, dtype=np.int64)
+        self.bins = np.zeros(self.shape + (0,), dtype=np.int64)
+        self.minIndex = 0
+
+    def _cover(self, low, high):
+        """
+        Widens the bins to cover the bucket indices low to high.
+        """
+        width = self.bins.shape[-1]
+        if width == 0:
+            self.minIndex = low
+        newMin = min(low, self.minIndex)
+        newMax = max(high, self.minIndex + width - 1)
+        before = self.minIndex - newMin
+        after = newMax - newMin + 1 - before - width
+        if before or after:
+            self.bins = np.pad(self.bins, [(0, 0)] * len(self.shape) + [(before, after)])
+            self.minIndex = newMin
+
+    def add(self, values):
+        """
+        Adds one value per element.
+
+        values: the values (an array of shape self.shape)
+        """
+        values = np.asarray(values, dtype=float)
+        if (values < 0).any():
+            raise ValueError('QuantileSketch only holds values of at least 0')
+        positive = values > 0
+        self.zeros += ~positive
+        if positive.any():
+            indices = np.ceil(np.log(values[positive]) / self.logGamma).astype(np.int64)
+            self._cover(int(indices.min()), int(indices.max()))
+            rows = self.bins.reshape(-1, self.bins.shape[-1])
+            rows[np.flatnonzero(positive), indices - self.minIndex] += 1
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch of the same shape and accuracy.
+        """
+        if other.shape != self.shape or other.relativeAccuracy != self.relativeAccuracy:
+            raise ValueError('Cannot merge sketches of different shapes or accuracies')
+        if other.bins.shape[-1]:
+            self._cover(other.minIndex, other.minIndex + other.bins.shape[-1] - 1)
+            start = other.minIndex - self.minIndex
+            self.bins[..., start:start + other.bins.shape[-1]] += other.bins
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def getQuantile(self, quantile):
+        """
+        Estimates a quantile of the values of every element.
+
+        quantile: the quantile (a float between 0-1)
+
+        returns: a float array of shape self.shape
+        """
+        if self.count == 0:
+            raise ValueError('Cannot estimate a quantile of an empty sketch')
+        rank = quantile * (self.count - 1)
+        cumulative = np.cumsum(np.concatenate((self.zeros[..., None], self.bins), axis=-1),
+                               axis=-1)
+        position = (cumulative > rank).argmax(axis=-1)
+        # the midpoint of bucket i, in relative terms, is 2 gamma^i / (gamma + 1)
+        values = 2 * self.gamma ** (position - 1 + self.minIndex) / (self.gamma + 1)
+        return np.where(position == 0, 0.0, values)
+
+
+class TrialAggregator(object):
+    """
+    Streaming per-timestep statistics over trials: the mean and variance of
+    every series at every timestep by Welford's method, and quantile
+    estimates from a QuantileSketch. Trials are folded in one at a time, so
+    memory does not grow with the number of trials, and aggregators built
+    by separate workers merge into one.
+    """
+
+    def __init__(self, seriesNames=None, relativeAccuracy=0.01):
+        """
+        seriesNames: the name of each series in a trial (a tuple of strings),
+        needed by getSummary()
+        relativeAccuracy: the relative error bound of the quantile estimates
+        (a float between 0-1)
+        """
+        self.seriesNames = seriesNames
+        self.relativeAccuracy = relativeAccuracy
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.sketch = None
+
+    def __str__(self):
+        return 'TrialAggregator of '+str(self.count)+' trials'
+
+    def emptyCopy(self):
+        """
+        Returns a new, empty aggregator with the same settings, e.g. for a
+        worker whose trials are merged back later.
+        """
+        return TrialAggregator(self.seriesNames, self.relativeAccuracy)
+
+    def addTrial(self, result):
+        """
+        Folds in the results of one trial.
+
+        result: one list of per-timestep values per series, as returned by
+        runTrialWithDrug
+        """
+        values = np.array(result, dtype=float)
+        if self.count == 0:
+            self.mean = np.zeros(values.shape)
+            self.m2 = np.zeros(values.shape)
+            self.sketch = QuantileSketch(values.shape, self.relativeAccuracy)
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+        self.sketch.add(values)
+
+    def merge(self, other):
+        """
+        Folds in the trials of another aggregator (Chan et al.'s pairwise
+        update of the mean and variance).
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.sketch = QuantileSketch(other.sketch.shape, self.relativeAccuracy)
+            self.sketch.merge(other.sketch)
+            self.count = other.count
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.sketch.merge(other.sketch)
+        self.count = count
+
+    def getCount(self):
+        """
+        Returns the number of trials folded in.
+        """
+        return self.count
+
+    def getMean(self):
+        """
+        Returns the per-timestep means (a float array with one row per
+        series).
+        """
+        return self.mean
+
+    def getVariance(self):
+        """
+        Returns the per-timestep sample variances (a float array with one row
+        per series; zeros while fewer than 2 trials have been added).
+        """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.count - 1)
+
+    def getQuantile(self, quantile):
+        """
+        Returns per-timestep quantile estimates (a float array with one row
+        per series, see QuantileSketch.getQuantile).
+        """
+        return self.sketch.getQuantile(quantile)
+
+    def getConfidenceInterval(self, z=1.96):
+        """
+        Returns the normal-approximation confidence interval of the mean:
+        a tuple (low, high) of float arrays, mean -/+ z standard errors.
+        """
+        halfWidth = z * np.sqrt(self.getVariance() / self.count)
+        return self.mean - halfWidth, self.mean + halfWidth
+
+    def getSummary(self, quantiles=None):
+        """
+        Returns the statistics as a dictionary mapping each statistic
+        ('mean', 'variance' and 'q' followed by each quantile, e.g. 'q0.05')
+        to a dictionary mapping each series name to its list of
+        per-timestep values.
+
+        quantiles: the quantiles to include (a tuple of floats between 0-1,
+        SWEEP_QUANTILES if None)
+        """
+        if quantiles is None:
+            quantiles = SWEEP_QUANTILES
+        statistics = {'mean': self.getMean(), 'variance': self.getVariance()}
+        for quantile in quantiles:
+            statistics['q'+str(quantile)] = self.getQuantile(quantile)
+        return {name: dict(zip(self.seriesNames, rows.tolist()))
+                for name, rows in statistics.items()}
+
+
+def makeTrialSeeds(seed, numTrials):
+    """
+    Derives one independent seed per trial from a master seed, so that a
+    trial draws the same random numbers whichever process runs it.
+
+    seed: the master seed (an integer), or None to draw fresh entropy
+
+    returns: a list of numTrials numpy SeedSequence instances
+    """
+    return np.random.SeedSequence(seed).spawn(numTrials)
+
+def seedTrial(seed):
+    """
+    Creates the generator a trial draws all of its random numbers from.
+
+    seed: the seed of the trial (a numpy SeedSequence), or None for an
+    unseeded generator
+
+    returns: a numpy-backed SimulationRNG
+    """
+    return SimulationRNG(seed)
+
+def _runTrialBatch(trialFunction, args, trials, seeds, keepResults=False, sink=None,
+                   aggregator=None):
+    """
+    Runs one trial of trialFunction for each of the trial numbers in trials,
+    seeded with the matching entry of seeds.
+
+    keepResults: whether to return the result of every trial (a boolean)
+    sink: a ResultsSink to write every trial to as it finishes, or None
+    aggregator: a TrialAggregator to fold every trial into, or None
+
+    returns: a tuple (sums, results, aggregator). sums holds the
+    per-timestep sums of the trial results (a numpy array with one row per
+    series returned by trialFunction); results is a list of (trial, result)
+    pairs if keepResults is True and empty otherwise.
+    """
+    sums = 0
+    results = []
+    for trial, seed in zip(trials, seeds):
+        result = trialFunction(*args, seed=seed)
+        sums = sums + np.array(result, dtype=np.int64)
+        if sink is not None:
+            sink.writeTrial(trial, result)
+        if aggregator is not None:
+            aggregator.addTrial(result)
+        if keepResults:
+            results.append((trial, result))
+    return sums, results, aggregator
+
+def runTrials(trialFunction, args, numTrials, numWorkers=1, seed=None, sink=None,
+              aggregator=None):
+    """
+    Runs numTrials independent trials and returns the per-timestep sums of
+    their results. Every trial gets its own seed from makeTrialSeeds(seed), so
+    the sums are the same for any number of workers.
+
+    With numWorkers above 1 the trials are split into batches that run on a
+    pool of worker processes, and the partial sums are merged as the batches
+    finish. trialFunction must then be defined at module level (or be a
+    functools.partial of such a function) so that it can be sent to the
+    workers.
+
+    trialFunction: a function such as runTrialWithDrug, called as
+    trialFunction(*args, seed=trialSeed) and returning a tuple of lists with
+    one population per timestep
+    args: the positional arguments for trialFunction (a tuple)
+    numTrials: number of trials to run (a positive integer)
+    numWorkers: number of worker processes (an integer, or None for one per
+    CPU). 1 runs every trial in this process.
+    seed: the master seed (an integer), or None to draw fresh entropy
+    sink: an opened ResultsSink that every trial is written to as soon as it
+    reaches this process, or None
+    aggregator: a TrialAggregator that every trial is folded into, or None.
+    Each worker aggregates its own batches, which are merged as they
+    finish, so no trajectory is kept.
+
+    returns: a numpy array with one row of per-timestep sums for each series
+    returned by trialFunction
+    """
+    if numTrials < 1:
+        raise ValueError('Cannot run fewer than 1 trial: '+str(numTrials))
+    seeds = makeTrialSeeds(seed, numTrials)
+    if numWorkers == 1:
+        return _runTrialBatch(trialFunction, args, range(numTrials), seeds, sink=sink,
+                              aggregator=aggregator)[0]
+    # imported here so that processes that only step patients do not pay
+    # for the multiprocessing machinery at import time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    if numWorkers is None:
+        numWorkers = os.cpu_count()
+    sums = 0
+    with ProcessPoolExecutor(max_workers=numWorkers) as pool:
+        # a few batches per worker keeps the pool balanced without paying
+        # the inter-process overhead on every single trial
+        numBatches = min(numTrials, 4 * numWorkers)
+        batches = [pool.submit(_runTrialBatch, trialFunction, args,
+                               range(i, numTrials, numBatches), seeds[i::numBatches],
+                               sink is not None, None,
+                               None if aggregator is None else aggregator.emptyCopy())
+                   for i in range(numBatches)]
+        for batch in as_completed(batches):
+            batchSums, results, batchAggregator = batch.result()
+            sums = sums + batchSums
+            for trial, result in results:
+                sink.writeTrial(trial, result)
+            if aggregator is not None:
+                aggregator.merge(batchAggregator)
+    return sums
+
+
+# The simulationWithDrug parameters a sweep can vary, with the values used
+# for the parameters a grid leaves out
+SWEEP_DEFAULTS = {'numViruses': 100, 'maxPop': 1000, 'maxBirthProb': 0.1,
+                  'clearProb': 0.05, 'resistances': {'guttagonol': False},
+                  'mutProb': 0.005, 'engine': 'object', 'schedule': None}
+SWEEP_QUANTILES = (0.05, 0.5, 0.95)
+
+def makeSweepPoints(grid):
+    """
+    Expands a parameter grid into the list of points it covers.
+
+    grid: a dictionary mapping parameter names (keys of SWEEP_DEFAULTS) to
+    lists of values, e.g. {'maxPop': [1000, 10000], 'mutProb': [.001, .005]}.
+    A list of DosingSchedules under 'schedule' compares regimens.
+
+    returns: a list of dictionaries, one per combination of grid values,
+    each holding a value for every parameter in SWEEP_DEFAULTS
+    """
+    for name in grid:
+        if name not in SWEEP_DEFAULTS:
+            raise ValueError('Cannot sweep over unknown parameter: '+str(name))
+    names = sorted(grid)
+    points = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        point = dict(SWEEP_DEFAULTS)
+        point.update(zip(names, values))
+        points.append(point)
+    return points
+
+def _sweepValue(value):
+    """
+    Returns a JSON-serializable form of a sweep parameter value.
+    """
+    return value.toDict() if isinstance(value, DosingSchedule) else value
+
+def _sweepPointKey(point, numTrials, pointSeed, quantiles):
+    """
+    Returns a string that identifies a sweep point in checkpoint files. The
+    key also holds the trial count, the point's seed and the quantiles, so a
+    summary is only reused by a sweep that would have computed the same one.
+
+    point: the sweep point (a dictionary)
+    numTrials: number of trials per point (an integer)
+    pointSeed: the point's seed (a numpy SeedSequence)
+    quantiles: the quantiles reported per timestep (a tuple of floats)
+    """
+    return json.dumps({'point': point, 'numTrials': numTrials,
+                       'seed': [pointSeed.entropy, list(pointSeed.spawn_key)],
+                       'quantiles': [float(q) for q in quantiles]},
+                      sort_keys=True, default=_sweepValue)
+
+def _sweepTrialArgs(point):
+    """
+    Returns the positional arguments of runTrialWithDrug for a sweep point.
+    """
+    return (point['numViruses'], point['maxPop'], point['maxBirthProb'], point['clearProb'],
+            point['resistances'], point['mutProb'], point['engine'], point['schedule'])
+
+def summarizeTrials(trials, seriesNames, quantiles=SWEEP_QUANTILES):
+    """
+    Computes per-timestep statistics over a set of trials.
+
+    trials: the results of the trials (a list of tuples of per-timestep
+    lists, as returned by runTrialWithDrug)
+    seriesNames: the name of each series in a trial (a tuple of strings)
+    quantiles: the quantiles to compute (a tuple of floats between 0-1)
+
+    returns: a dictionary mapping each statistic ('mean', 'variance' and
+    'q' followed by each quantile, e.g. 'q0.05') to a dictionary mapping each
+    series name to its list of per-timestep values (see
+    TrialAggregator.getSummary; the quantiles are sketch estimates)
+    """
+    aggregator = TrialAggregator(seriesNames)
+    for result in trials:
+        aggregator.addTrial(result)
+    return aggregator.getSummary(quantiles)
+
+def readSweepCheckpoint(checkpointPath):
+    """
+    Reads the summaries of the points finished by an earlier sweep.
+
+    returns: a dictionary mapping sweep point keys to summaries (see
+    summarizeTrials). A line cut short by an interrupted write is ignored.
+    """
+    finished = {}
+    if not os.path.exists(checkpointPath):
+        return finished
+    with open(checkpointPath) as checkpointFile:
+        for line in checkpointFile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            finished[entry['key']] = entry['summary']
+    return finished
+
+def writeSweepTable(outputPath, points, summaries):
+    """
+    Writes the aggregated results of a sweep as a CSV table with one row per
+    point, series and timestep. The columns are the sweep parameters, series,
+    timestep and one column per statistic.
+
+    points: the sweep points (a list of dictionaries)
+    summaries: the summary of every point (a list of summaries, see
+    summarizeTrials)
+    """
+    names = sorted(SWEEP_DEFAULTS)
+    statistics = list(summaries[0]) if summaries else ['mean', 'variance']
+    temporaryPath = outputPath + '.tmp'
+    with open(temporaryPath, 'w', newline='') as outputFile:
+        writer = csv.writer(outputFile)
+        writer.writerow(names + ['series', 'timestep'] + statistics)
+        for point, summary in zip(points, summaries):
+            params = [json.dumps(point[name], default=_sweepValue)
+                      if isinstance(point[name], (dict, DosingSchedule)) else point[name]
+                      for name in names]
+            for series in summary['mean']:
+                for timestep in range(len(summary['mean'][series])):
+                    writer.writerow(params + [series, timestep + 1] +
+                                    [summary[statistic][series][timestep]
+                                     for statistic in statistics])
+    os.replace(temporaryPath, outputPath)
+
+def parameterSweep(grid, numTrials, outputPath, numWorkers=1, seed=None,
+                   checkpointPath=None, quantiles=SWEEP_QUANTILES):
+    """
+    Runs numTrials trials of simulationWithDrug at every point of a parameter
+    grid and writes one aggregated results table.
+
+    Every (point, trial) pair is a separate task. With numWorkers above 1
+    the tasks are handed to a process pool as workers free up, so points
+    with a large maxPop do not hold up the rest of the sweep. Each point and
+    trial gets its own seed derived from seed, so results do not depend on
+    numWorkers.
+
+    When a point has all of its trials, its summary is appended to the
+    checkpoint file. Rerunning an interrupted sweep with the same grid,
+    numTrials, seed, quantiles and checkpointPath skips the points found
+    there; points finished under other settings are run again.
+
+    grid: the parameter grid (see makeSweepPoints)
+    numTrials: number of trials per point (a positive integer)
+    outputPath: the CSV file for the results table (a string, see
+    writeSweepTable)
+    numWorkers: number of worker processes (an integer, or None for one per
+    CPU). 1 runs every trial in this process.
+    seed: the master seed (an integer), or None to draw fresh entropy
+    checkpointPath: the checkpoint file (a string), or None for no
+    checkpointing
+    quantiles: the quantiles to report per timestep (a tuple of floats)
+
+    returns: a list of (point, summary) tuples, one per grid point (see
+    makeSweepPoints and summarizeTrials)
+    """
+    if numTrials < 1:
+        raise ValueError('Cannot run fewer than 1 trial per point: '+str(numTrials))
+    points = makeSweepPoints(grid)
+    pointSeeds = np.random.SeedSequence(seed).spawn(len(points))
+    keys = [_sweepPointKey(point, numTrials, pointSeed, quantiles)
+            for point, pointSeed in zip(points, pointSeeds)]
+    finished = readSweepCheckpoint(checkpointPath) if checkpointPath else {}
+    # each unfinished point folds its trials into an aggregator as they
+    # arrive, so no trajectory is kept
+    aggregators = {}
+    tasks = []
+    for index, point in enumerate(points):
+        if keys[index] not in finished:
+            aggregators[index] = TrialAggregator(withDrugSeries(point['schedule']))
+            for trialSeed in pointSeeds[index].spawn(numTrials):
+                tasks.append((index, trialSeed))
+
+    def finishTrial(index, result):
+        aggregators[index].addTrial(result)
+        if aggregators[index].getCount() == numTrials:
+            key = keys[index]
+            finished[key] = aggregators.pop(index).getSummary(quantiles)
+            if checkpointPath:
+                with open(checkpointPath, 'a') as checkpointFile:
+                    checkpointFile.write(json.dumps({'key': key, 'summary': finished[key]})+'\n')
+
+    if numWorkers == 1:
+        for index, trialSeed in tasks:
+            finishTrial(index, runTrialWithDrug(*_sweepTrialArgs(points[index]), seed=trialSeed))
+    elif tasks:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=numWorkers) as pool:
+            futures = {pool.submit(runTrialWithDrug, *_sweepTrialArgs(points[index]),
+                                   seed=trialSeed): index
+                       for index, trialSeed in tasks}
+            for future in as_completed(futures):
+                finishTrial(futures[future], future.result())
+
+    summaries = [finished[key] for key in keys]
+    writeSweepTable(outputPath, points, summaries)
+    return list(zip(points, summaries))
+
+
+class ResultsSink(object):
+    """
+    Receives the per-trial, per-timestep results of a simulation as the run
+    proceeds, so that runs do not need to keep every trajectory in memory.
+    Subclasses write the records somewhere; each record holds a trial
+    number, a timestep (starting at 1) and one value per series.
+    """
+
+    def open(self, seriesNames):
+        """
+        Called once before the first trial is written.
+
+        seriesNames: the names of the series each trial produces (a tuple of
+        strings, e.g. ('total', 'resistant_guttagonol'))
+        """
+        self.seriesNames = tuple(seriesNames)
+
+    def writeTrial(self, trial, series):
+        """
+        Records the results of one trial. Trials may arrive in any order.
+
+        trial: the number of the trial (an integer)
+        series: one list of per-timestep values per series name
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Called once after the last trial is written.
+        """
+
+
+class CSVSink(ResultsSink):
+    """
+    Writes one CSV row per trial and timestep, with the columns trial,
+    timestep and one column per series.
+    """
+
+    def __init__(self, path):
+        """
+        path: the CSV file to write (a string)
+        """
+        self.path = path
+        self.file = None
+
+    def open(self, seriesNames):
+        ResultsSink.open(self, seriesNames)
+        self.file = open(self.path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(('trial', 'timestep') + self.seriesNames)
+
+    def writeTrial(self, trial, series):
+        self.writer.writerows((trial, timestep + 1) + values
+                              for timestep, values in enumerate(zip(*series)))
+
+    def close(self):
+        self.file.close()
+
+
+class NPYSink(ResultsSink):
+    """
+    Writes the results column by column, one .npy file per column (trial,
+    timestep and each series) in a directory. Rows are appended to raw
+    files as trials arrive and turned into .npy files on close(), so the
+    columns can later be loaded with numpy.load(..., mmap_mode='r').
+    """
+
+    def __init__(self, directory):
+        """
+        directory: the directory to write the .npy files to (a string). It is
+        created if needed.
+        """
+        self.directory = directory
+        self.files = {}
+
+    def _path(self, column, suffix):
+        return os.path.join(self.directory, column + suffix)
+
+    def open(self, seriesNames):
+        ResultsSink.open(self, seriesNames)
+        os.makedirs(self.directory, exist_ok=True)
+        for column in ('trial', 'timestep') + self.seriesNames:
+            self.files[column] = open(self._path(column, '.raw'), 'wb')
+
+    def writeTrial(self, trial, series):
+        numSteps = len(series[0])
+        self.files['trial'].write(np.full(numSteps, trial, dtype=np.int64).tobytes())
+        self.files['timestep'].write(np.arange(1, numSteps + 1, dtype=np.int64).tobytes())
+        for column, values in zip(self.seriesNames, series):
+            self.files[column].write(np.asarray(values, dtype=np.int64).tobytes())
+
+    def close(self):
+        for column, rawFile in self.files.items():
+            rawFile.close()
+            rawPath = self._path(column, '.raw')
+            numRows = os.path.getsize(rawPath) // 8
+            values = np.lib.format.open_memmap(self._path(column, '.npy'), mode='w+',
+                                               dtype=np.int64, shape=(numRows,))
+            if numRows:
+                values[:] = np.memmap(rawPath, dtype=np.int64, mode='r')
+            values.flush()
+            del values
+            os.remove(rawPath)
+        self.files = {}
+
+
+class ParquetSink(ResultsSink):
+    """
+    Writes the results to a Parquet file, one row group per trial. Needs the
+    optional pyarrow package, which is only imported when the sink opens.
+    """
+
+    def __init__(self, path):
+        """
+        path: the Parquet file to write (a string)
+        """
+        self.path = path
+        self.writer = None
+
+    def open(self, seriesNames):
+        ResultsSink.open(self, seriesNames)
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(column, pyarrow.int64())
+                                      for column in ('trial', 'timestep') + self.seriesNames])
+        self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+
+    def writeTrial(self, trial, series):
+        numSteps = len(series[0])
+        columns = [np.full(numSteps, trial, dtype=np.int64),
+                   np.arange(1, numSteps + 1, dtype=np.int64)]
+        columns += [np.asarray(values, dtype=np.int64) for values in series]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
 
 
 # SIMULATION WITHOUT DRUG